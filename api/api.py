@@ -1,12 +1,20 @@
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Iterator, Callable
 
-import requests
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, urljoin
 from datetime import datetime
 from pathvalidate import sanitize_filename
 
 from .auth import NCPAuth
+from .cache import ResponseCache
+from .rate_limiter import RateLimiter
+from .transport import Transport
+from util.metrics import Metrics
+
+DEFAULT_PER_PAGE = 12  # page size used by the site itself
+MAX_PER_PAGE = 100  # page size asked for when listing videos, the server may cap it
 
 
 class SessionID(object):
@@ -28,9 +36,17 @@ class ChannelID(object):
 
 
 class ContentCode(object):
-    """Content code of video"""
-    def __init__(self, content_code: str) -> None:
+    """
+    Content code of video
+
+    Args:
+        content_code (str): content code
+        video_page (dict, optional): video page from the video list of channel (title, released_at, ...).
+            Defaults to None.
+    """
+    def __init__(self, content_code: str, video_page: Optional[dict] = None) -> None:
         self.content_code = content_code
+        self.video_page = video_page
 
     def __repr__(self) -> str:
         return str(self.content_code)
@@ -44,51 +60,146 @@ class NCP(object):
         site_base (str): site base
         username (str, optional): username. Defaults to None.
         password (str, optional): password. Defaults to None.
+        pool_size (int, optional): max number of keep-alive connections per host. Defaults to 10.
+        rate_limits (dict, optional): requests per second of each endpoint class
+            ('api', 'auth', 'hls', 'segment'). Defaults to None (adaptive defaults).
+        cache (ResponseCache, optional): persistent cache of metadata responses. Defaults to None (no cache).
+        scheme (str, optional): scheme of the site, e.g. 'http' for a local stand-in server. Defaults to 'https'.
+        metrics (Metrics, optional): metrics of requests per endpoint class. Defaults to disabled metrics.
     """
-    def __init__(self, site_base: str, username: Optional[str], password: Optional[str]) -> None:
-        self.site_base = f'https://{site_base}'
+    # seconds a cached response stays fresh before it is revalidated, 0 means always revalidate
+    CACHE_TTL = {
+        'settings': 24 * 60 * 60,
+        'login': 24 * 60 * 60,
+        'channels': 24 * 60 * 60,
+        'channel_info': 6 * 60 * 60,
+        'video_page': 24 * 60 * 60,
+        'public_status': 60 * 60,
+        'video_list': 0,
+    }
+
+    def __init__(self, site_base: str, username: Optional[str], password: Optional[str],
+                 pool_size: int = 10, rate_limits: Optional[dict] = None,
+                 cache: Optional[ResponseCache] = None, scheme: str = 'https',
+                 metrics: Optional[Metrics] = None) -> None:
+        self.site_netloc = site_base
+        self.site_base = f'{scheme}://{site_base}'
+        self.username = username
+        self.password = password
         self.headers = {
             'Origin': self.site_base,
             'Fc_use_device': 'null'
         }
 
+        # shared connection pool, used by api, auth and downloaders
+        # the site headers are sent with each request to the site (and segments), not as defaults of the pool,
+        # so auth0 and the hls hosts never get them
+        self.transport = Transport(None, pool_size, RateLimiter(rate_limits), cache, metrics)
+
         # this api is used to get api_base_url, fanclub_site_id, platform_id
         self.api_settings = f'{self.site_base}/site/settings.json'
-        self.api_base, self.fanclub_site_id, self.platform_id = self.__initial_api()
+        self.api_video_index = 'https://hls-auth.cloud.stream.co.jp/auth/index.m3u8?session_id=%s'  # session_id
 
+        # settings, login info and auth are fetched on first use, so nothing blocks before it is needed
+        self.lock = threading.RLock()
+        self.__site_settings = None
+        self.__auth_settings = None
+        self.__auth = None
+        self.__auth_initialized = False
+
+    @property
+    def api_base(self) -> str:
+        return self.__get_site_settings()[0]
+
+    @property
+    def fanclub_site_id(self) -> str:
+        return self.__get_site_settings()[1]
+
+    @property
+    def platform_id(self) -> str:
+        return self.__get_site_settings()[2]
+
+    @property
+    def auth_base(self) -> str:
+        return self.__get_auth_settings()[0]
+
+    @property
+    def auth_client_id(self) -> str:
+        return self.__get_auth_settings()[1]
+
+    @property
+    def auth(self) -> Optional[NCPAuth]:
+        """Auth of the user, login on first use. None if no username and password are given"""
+        with self.lock:
+            if not self.__auth_initialized:
+                if self.username is not None and self.password is not None:
+                    self.__auth = NCPAuth(self.username, self.password, self.site_netloc, self.fanclub_site_id,
+                                          self.platform_id, self.auth_client_id, self.auth_base,
+                                          urlparse(self.api_base).netloc, self.transport)
+                self.__auth_initialized = True
+
+            return self.__auth
+
+    # endpoints
+    @property
+    def api_login(self) -> str:
         # api_login: %s = fanclub_site_id
         # this api is used to get data.fanclub_site.auth0_web_client_id(client_id) &
         #                         data.fanclub_site.fanclub_group.auth0_domain(auth0_domain)
-        self.api_login = f'{self.api_base}/fanclub_sites/%s/login'
-        self.auth_base, self.auth_client_id = self.__initial_auth()
-
-        # initial auth
-        if username is not None and password is not None:
-            self.auth = NCPAuth(username, password, site_base, self.fanclub_site_id,
-                                self.platform_id, self.auth_client_id, self.auth_base,
-                                urlparse(self.api_base).netloc)
-        else:
-            self.auth = None
-
-        # endpoints
-        self.api_channels = f'{self.api_base}/content_providers/channels'
-        self.api_channel_info = f'{self.api_base}/fanclub_sites/%s/page_base_info'  # channel_id
-        self.api_video_page = f'{self.api_base}/video_pages/%s'  # content_code
-        self.api_public_status = f'{self.api_base}/video_pages/%s/public_status'  # content_code
-        self.api_session_id = f'{self.api_base}/video_pages/%s/session_ids'  # content_code
-        self.api_video_list = f'{self.api_base}/fanclub_sites/%s/video_pages?vod_type=%d&page=%d&per_page=%d&sort=%s'
-        self.api_video_index = 'https://hls-auth.cloud.stream.co.jp/auth/index.m3u8?session_id=%s'  # session_id
+        return f'{self.api_base}/fanclub_sites/%s/login'
+
+    @property
+    def api_channels(self) -> str:
+        return f'{self.api_base}/content_providers/channels'
+
+    @property
+    def api_channel_info(self) -> str:
+        return f'{self.api_base}/fanclub_sites/%s/page_base_info'  # channel_id
+
+    @property
+    def api_video_page(self) -> str:
+        return f'{self.api_base}/video_pages/%s'  # content_code
+
+    @property
+    def api_public_status(self) -> str:
+        return f'{self.api_base}/video_pages/%s/public_status'  # content_code
+
+    @property
+    def api_session_id(self) -> str:
+        return f'{self.api_base}/video_pages/%s/session_ids'  # content_code
+
+    @property
+    def api_video_list(self) -> str:
+        return f'{self.api_base}/fanclub_sites/%s/video_pages?vod_type=%d&page=%d&per_page=%d&sort=%s'
+
+    def __get_site_settings(self) -> Tuple[str, str, str]:
+        """Get api base, fanclub site id and platform id, fetched once"""
+        with self.lock:
+            if self.__site_settings is None:
+                self.__site_settings = self.__initial_api()
+
+            return self.__site_settings
+
+    def __get_auth_settings(self) -> Tuple[str, str]:
+        """Get auth0 domain and client id, fetched once"""
+        with self.lock:
+            if self.__auth_settings is None:
+                self.__auth_settings = self.__initial_auth()
+
+            return self.__auth_settings
 
     def __initial_api(self) -> Tuple[str, str, str]:
         """Initial api base from settings"""
-        req = requests.get(self.api_settings, headers=self.headers)
+        req = self.transport.get(self.api_settings, ttl=self.CACHE_TTL['settings'], name='settings',
+                                 headers=self.headers)
         resp = req.json()
 
         return resp['api_base_url'], resp['fanclub_site_id'], resp['platform_id']
 
     def __initial_auth(self) -> Tuple[str, str]:
         """Initial auth base from login api"""
-        req = requests.get(self.api_login % self.fanclub_site_id, headers=self.headers)
+        req = self.transport.get(self.api_login % self.fanclub_site_id, ttl=self.CACHE_TTL['login'], name='login',
+                                 headers=self.headers)
         resp = req.json()
 
         return (resp['data']['fanclub_site']['fanclub_group']['auth0_domain'],
@@ -103,7 +214,8 @@ class NCP(object):
                 if channel['domain'] == query.geturl().strip('/'):
                     return ChannelID(channel['id'])
         else:
-            r = requests.get(urljoin(query.geturl(), './site/settings.json'))
+            r = self.transport.get(urljoin(query.geturl(), './site/settings.json'), ttl=self.CACHE_TTL['settings'],
+                                   name='settings')
             if r.status_code == 200 and r.headers['Content-Type'] == 'application/json':
                 return ChannelID(r.json()['fanclub_site_id'])
 
@@ -111,30 +223,111 @@ class NCP(object):
 
     def get_channel_info(self, channel_id: ChannelID) -> dict:
         """Get channel info from channel id"""
-        r = requests.get(self.api_channel_info % channel_id, headers=self.headers)
+        r = self.transport.get(self.api_channel_info % channel_id, ttl=self.CACHE_TTL['channel_info'],
+                               name='channel_info', headers=self.headers)
         return r.json()['data']['fanclub_site']
 
     def list_channels(self) -> list:
         """Get channel list"""
-        r = requests.get(self.api_channels, headers=self.headers)
+        r = self.transport.get(self.api_channels, ttl=self.CACHE_TTL['channels'], name='channels',
+                               headers=self.headers)
         return r.json()['data']['content_providers']
 
     def list_videos(self,
                     channel_id: ChannelID,
                     vod_type: int = 0,
-                    page: int = 1,
-                    per_page: int = 12,
+                    per_page: int = MAX_PER_PAGE,
                     sort: str = '-display_date') -> list:
         """Get video list of channel from channel id"""
-        r = requests.get(self.api_video_list % (channel_id, vod_type, page, per_page, sort), headers=self.headers)
-        video_list = r.json()['data']['video_pages']['list']
-        if len(r.json()['data']['video_pages']['list']) < r.json()['data']['video_pages']['total']:
-            while len(video_list) < r.json()['data']['video_pages']['total']:
-                page += 1
-                r = requests.get(self.api_video_list % (channel_id, vod_type, page, per_page, sort),
-                                 headers=self.headers)
-                video_list += r.json()['data']['video_pages']['list']
-        return video_list
+        return list(self.iter_videos(channel_id, vod_type, per_page, sort))
+
+    def iter_videos(self,
+                    channel_id: ChannelID,
+                    vod_type: int = 0,
+                    per_page: int = MAX_PER_PAGE,
+                    sort: str = '-display_date',
+                    concurrency: int = 4,
+                    until: Callable[[dict], bool] = None) -> Iterator[dict]:
+        """
+        Yield videos of channel from channel id, in listing order
+
+        The first page reveals the total, the remaining pages are fetched concurrently (paced by the rate limiter)
+        while the videos of the pages before them are being consumed.
+
+        With until, listing stops before the first video it returns True for (e.g. the newest video of the last
+        sync), and pages are fetched one at a time so no page past that video is requested.
+        """
+        videos, total, per_page = self.__first_video_page(channel_id, vod_type, per_page, sort)
+
+        # the server may return fewer videos than asked for, page with the size it actually uses
+        pages = -(-total // per_page) if videos else 0
+
+        if until is not None:
+            yield from self.__iter_videos_until(channel_id, vod_type, per_page, sort, videos, pages, until)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=concurrency) if pages > 1 else None
+        futures = [executor.submit(self.__video_page, channel_id, vod_type, page, per_page, sort)
+                   for page in range(2, pages + 1)] if executor is not None else []
+
+        try:
+            seen = set()
+            for page in [None, *futures]:
+                if page is not None:
+                    videos, _ = page.result()
+
+                for video in videos:
+                    # a video published while paging shifts the pages, don't yield it twice
+                    if video['content_code'] not in seen:
+                        seen.add(video['content_code'])
+                        yield video
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def __iter_videos_until(self, channel_id: ChannelID, vod_type: int, per_page: int, sort: str, videos: list,
+                            pages: int, until: Callable[[dict], bool]) -> Iterator[dict]:
+        """Yield videos page by page, starting with the videos of the first page, until a video matches until"""
+        seen = set()
+        for page in range(2, pages + 2):
+            for video in videos:
+                if until(video):
+                    return
+                if video['content_code'] not in seen:
+                    seen.add(video['content_code'])
+                    yield video
+
+            if page <= pages:
+                videos, _ = self.__video_page(channel_id, vod_type, page, per_page, sort)
+
+    def __first_video_page(self, channel_id: ChannelID, vod_type: int, per_page: int,
+                           sort: str) -> Tuple[list, int, int]:
+        """Get the first page of videos, return videos, total and the page size used by the server"""
+        try:
+            videos, total = self.__video_page(channel_id, vod_type, 1, per_page, sort)
+        except RuntimeError:
+            if per_page <= DEFAULT_PER_PAGE:
+                raise
+            # the page size is not accepted, fall back to the one used by the site
+            per_page = DEFAULT_PER_PAGE
+            videos, total = self.__video_page(channel_id, vod_type, 1, per_page, sort)
+
+        if len(videos) < min(per_page, total):
+            per_page = len(videos)
+
+        return videos, total, per_page
+
+    def __video_page(self, channel_id: ChannelID, vod_type: int, page: int, per_page: int,
+                     sort: str) -> Tuple[list, int]:
+        """Get a page of videos, return videos and total"""
+        r = self.transport.get(self.api_video_list % (channel_id, vod_type, page, per_page, sort),
+                               ttl=self.CACHE_TTL['video_list'], name='video_list', headers=self.headers)
+        if r.status_code != 200:
+            raise RuntimeError(f'Failed to list videos of channel {channel_id} (page {page}).')
+
+        video_pages = r.json()['data']['video_pages']  # parse once
+
+        return video_pages['list'], video_pages['total']
 
     def list_lives(self, channel_id: str, live_type) -> list:
         """Get live list of channel from channel id"""
@@ -143,11 +336,19 @@ class NCP(object):
 
     def get_session_id(self, content_code: ContentCode) -> Optional[SessionID]:
         """Get session id of video from content code"""
-        r = requests.post(self.api_session_id % content_code,
-                          headers=dict({'Content-Type': 'application/json'},
-                                       **({'Authorization': f'Bearer {self.auth}'} if self.auth is not None else {}),
-                                       **self.headers),
-                          data=json.dumps({}))
+        headers = {'Content-Type': 'application/json', **self.headers}
+        if self.auth is not None:
+            headers['Authorization'] = f'Bearer {self.auth}'
+
+        r = self.transport.post(self.api_session_id % content_code, headers=headers, data=json.dumps({}),
+                                name='session_id')
+        if r.status_code == 401 and self.auth is not None:
+            # the token expired earlier than we thought, refresh and try once more
+            self.auth.refresh(headers['Authorization'].removeprefix('Bearer '))
+            headers['Authorization'] = f'Bearer {self.auth}'
+            r = self.transport.post(self.api_session_id % content_code, headers=headers, data=json.dumps({}),
+                                    name='session_id')
+
         if r.status_code == 200:
             return SessionID(r.json()['data']['session_id'])
         else:
@@ -155,12 +356,14 @@ class NCP(object):
 
     def get_public_status(self, content_code: ContentCode) -> dict:
         """Get public status of video from content code"""
-        r = requests.get(self.api_public_status % content_code, headers=self.headers)
+        r = self.transport.get(self.api_public_status % content_code, ttl=self.CACHE_TTL['public_status'],
+                               name='public_status', headers=self.headers)
         return r.json()['data']['video_page']
 
     def get_video_page(self, content_code: ContentCode) -> Optional[dict]:
         """Get video page of video from content code"""
-        r = requests.get(self.api_video_page % content_code, headers=self.headers)
+        r = self.transport.get(self.api_video_page % content_code, ttl=self.CACHE_TTL['video_page'], name='video_page',
+                               headers=self.headers)
         if r.status_code == 200:
             return r.json()['data']['video_page']
         else:
@@ -168,8 +371,10 @@ class NCP(object):
 
     def get_video_name(self, content_code: ContentCode, known_title: str = None,
                        _format: str = '%release_date% %title% [%content_code%]') -> Tuple[str, str]:
-        """Get video name from content code"""
-        video_page = self.get_video_page(content_code)
+        """Get video name from content code, the video page from the video list is used if it has what we need"""
+        video_page = content_code.video_page
+        if video_page is None or 'title' not in video_page or 'released_at' not in video_page:
+            video_page = self.get_video_page(content_code)
 
         if video_page is not None:
             title = video_page['title']
@@ -1,13 +1,18 @@
-from typing import Tuple
+from typing import Tuple, Optional
 from enum import Enum
 
+import time
 import random
 import base64
 import hashlib
-from requests import session
 import json
+import threading
 from urllib.parse import urlencode, urlparse, parse_qs
 
+from .transport import Transport
+
+EXPIRY_MARGIN = 60  # seconds before expiry at which the access token is refreshed
+
 
 class Method(Enum):
     """
@@ -29,10 +34,12 @@ class NCPAuth(object):
         client_id (str): client id
         auth0_domain (str): auth0 domain
         audience (str): audience
+        transport (Transport, optional): shared transport. Defaults to a dedicated one.
     """
     def __init__(self, username: str, password: str, site_base: str, site_id: str,
-                 platform_id: str, client_id: str, auth0_domain: str, audience: str) -> None:
-        self.session = session()
+                 platform_id: str, client_id: str, auth0_domain: str, audience: str,
+                 transport: Optional[Transport] = None) -> None:
+        self.transport = transport if transport is not None else Transport()
 
         self.username = username
         self.password = password
@@ -65,27 +72,55 @@ class NCPAuth(object):
             'Auth0-Client': self.auth0_client
         }
 
-        self.access_token, self.refresh_token = self.__initial_token()
+        # workers share this object, only one of them refreshes the tokens
+        self.lock = threading.Lock()
+        self.access_token, self.refresh_token, self.expires_at = self.__initial_token()
 
     def __str__(self) -> str:
         """
         Auto refresh access token if expired, and return it
-        If access token is expired, refresh it
+        The expiry is tracked locally (exp claim of the token or expires_in of the token response),
+        so the token is refreshed shortly before it expires without asking the server.
         If refresh token is expired, login again
         If login failed, raise RuntimeError
         """
-        # check if access token is expired
-        if not self.__check_status():
-            try:
-                self.access_token, self.refresh_token = self.__request_token(Method.REFRESH)
-            except RuntimeError:
-                # if failed to refresh, login again
-                self.access_token, self.refresh_token = self.__request_token(Method.LOGIN)
+        if self.__expiring():
+            with self.lock:
+                if self.__expiring():  # another worker may have refreshed it while we were waiting
+                    self.__refresh()
 
         return self.access_token
 
+    def refresh(self, rejected_token: str) -> None:
+        """
+        Refresh tokens after the server rejected the access token (e.g. 401), unless it is already refreshed
+
+        The local expiry may be wrong (revoked token, clock skew), so ask the server before refreshing.
+
+        Args:
+            rejected_token (str): access token rejected by the server
+        """
+        with self.lock:
+            if self.access_token != rejected_token:
+                return  # refreshed by another worker
+
+            if not self.__check_status():
+                self.__refresh()
+
+    def __expiring(self) -> bool:
+        """Check if access token expires within the margin, an unknown expiry is only found out by a 401"""
+        return self.expires_at is not None and time.time() >= self.expires_at - EXPIRY_MARGIN
+
+    def __refresh(self) -> None:
+        """Refresh tokens, login again if failed to refresh"""
+        try:
+            self.access_token, self.refresh_token, self.expires_at = self.__request_token(Method.REFRESH)
+        except RuntimeError:
+            # if failed to refresh, login again
+            self.access_token, self.refresh_token, self.expires_at = self.__request_token(Method.LOGIN)
+
     def __initial_openid(self) -> Tuple[str, str]:
-        r = self.session.get(self.openid_configuration)
+        r = self.transport.get(self.openid_configuration, endpoint='auth')
         if r.status_code != 200:
             raise RuntimeError('Failed to get openid configuration')
 
@@ -93,7 +128,7 @@ class NCPAuth(object):
 
         return openid_configuration['authorization_endpoint'], openid_configuration['token_endpoint']
 
-    def __initial_token(self) -> Tuple[str, str]:
+    def __initial_token(self) -> Tuple[str, str, Optional[float]]:
         """
         Initial token
 
@@ -102,7 +137,9 @@ class NCPAuth(object):
         try:
             with open(f'tokens_{hashlib.md5(self.username.encode()).hexdigest()}.json', 'r') as f:
                 tokens = json.load(f)
-                return tokens['access_token'], tokens['refresh_token']
+                # files written by older versions have no expiry, take it from the token
+                expires_at = tokens.get('expires_at', self.__token_expiry(tokens['access_token']))
+                return tokens['access_token'], tokens['refresh_token'], expires_at
         except FileNotFoundError:
             return self.__request_token(Method.LOGIN)
 
@@ -134,7 +171,7 @@ class NCPAuth(object):
 
         return f'{self.authorization_endpoint}?{urlencode(params)}'
 
-    def __request_token(self, method: Method) -> Tuple[str, str]:
+    def __request_token(self, method: Method) -> Tuple[str, str, Optional[float]]:
         match method:
             case Method.LOGIN:
                 # login
@@ -142,25 +179,25 @@ class NCPAuth(object):
                 # - get authorize url -> this will redirect to login page
                 # - post login page with username and password -> this will redirect to redirect uri with code
                 # - post token endpoint with code -> this will return access token and refresh token
-                r_login_page = self.session.get(self.__prepare_authorize_url())
+                r_login_page = self.transport.get(self.__prepare_authorize_url(), endpoint='auth')
                 if r_login_page.status_code != 200:
                     raise RuntimeError('Failed to get login page')
 
-                r_redirect = self.session.post(r_login_page.url, {
+                r_redirect = self.transport.post(r_login_page.url, {
                     'username': self.username,
                     'password': self.password,
                     'state': parse_qs(urlparse(r_login_page.url).query)['state'][0]
-                }, headers=self.headers)
+                }, endpoint='auth', headers=self.headers)
                 if r_redirect.status_code != 404 and 'code' not in parse_qs(urlparse(r_redirect.url).query):
                     raise RuntimeError('Failed to login')
 
-                r_token = self.session.post(self.token_endpoint, {
+                r_token = self.transport.post(self.token_endpoint, {
                     'client_id': self.client_id,
                     'code_verifier': self.code_verifier,
                     'grant_type': 'authorization_code',
                     'code': parse_qs(urlparse(r_redirect.url).query)['code'][0],
                     'redirect_uri': self.redirect_uri
-                }, headers=self.headers)
+                }, endpoint='auth', headers=self.headers)
                 if r_token.status_code != 200 or \
                         'access_token' not in r_token.json() or 'refresh_token' not in r_token.json():
                     raise RuntimeError('Failed to get access token')
@@ -168,12 +205,12 @@ class NCPAuth(object):
                 # refresh access token
                 # workflow:
                 # - post token endpoint with refresh token -> this will return access token and refresh token
-                r_token = self.session.post(self.token_endpoint, {
+                r_token = self.transport.post(self.token_endpoint, {
                     'client_id': self.client_id,
                     'redirect_uri': self.redirect_uri,
                     'grant_type': 'refresh_token',
                     'refresh_token': self.refresh_token
-                }, headers=self.headers)
+                }, endpoint='auth', headers=self.headers)
                 if r_token.status_code != 200 or \
                         'access_token' not in r_token.json() or 'refresh_token' not in r_token.json():
                     # failed to refresh access token, login again
@@ -183,24 +220,44 @@ class NCPAuth(object):
 
         token = r_token.json()
 
+        # prefer the exp claim, expires_in is relative to the response
+        expires_at = self.__token_expiry(token['access_token'])
+        if expires_at is None and 'expires_in' in token:
+            expires_at = time.time() + float(token['expires_in'])
+
         # dump tokens to file
         with open(f'tokens_{hashlib.md5(self.username.encode()).hexdigest()}.json', 'w') as f:
             json.dump({
                 'access_token': token['access_token'],
-                'refresh_token': token['refresh_token']
+                'refresh_token': token['refresh_token'],
+                'expires_at': expires_at
             }, f)
 
-        return token['access_token'], token['refresh_token']
+        return token['access_token'], token['refresh_token'], expires_at
 
     def __check_status(self) -> bool:
         """
         Check auth status(by user_info endpoint)
-        This is used to check if access token is expired
+        This is only used to confirm that access token is expired after the server rejected it
         """
-        r = self.session.post(self.api_user_info, headers=self.headers)
+        r = self.transport.post(self.api_user_info, endpoint='auth',
+                                headers={**self.headers, 'Authorization': f'Bearer {self.access_token}'})
 
         return r.status_code == 200
 
+    @staticmethod
+    def __token_expiry(access_token: str) -> Optional[float]:
+        """
+        Get expiry time from the exp claim of access token(JWT), None if it is not a JWT
+        The signature is not verified, the server does that
+        """
+        try:
+            payload = access_token.split('.')[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+            return float(claims['exp'])
+        except (IndexError, ValueError, KeyError, TypeError):
+            return None
+
     @staticmethod
     def __rand(size=43):
         """
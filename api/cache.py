@@ -0,0 +1,152 @@
+import time
+import sqlite3
+import pathlib
+import threading
+from typing import Callable, Optional
+
+from requests import Response, RequestException
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024  # bytes of cached bodies kept on disk
+GONE_STATUS = (404, 410)  # the only answers a cached response is dropped for
+
+
+class ResponseCache(object):
+    """
+    Persistent cache of API metadata responses
+
+    Successful GET responses are kept in a sqlite database with an expiry time set by the caller.
+    A fresh entry is served without any request, an expired one is revalidated with If-None-Match /
+    If-Modified-Since when the server gave us an ETag or Last-Modified, so unchanged metadata costs a 304 at most.
+    When revalidation fails (429, 5xx or a connection error) the stale entry is served instead (stale-if-error),
+    it is only dropped once the server says it is gone (404, 410).
+    Least recently used entries are evicted once the cached bodies exceed max_size.
+
+    Args:
+        path (str or pathlib.Path): path of the cache database
+        max_size (int, optional): max bytes of cached bodies. Defaults to DEFAULT_MAX_SIZE.
+    """
+    def __init__(self, path: str or pathlib.Path, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.path = pathlib.Path(path)
+        self.max_size = max_size
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        # shared by the threads paging the video list, every access holds the lock
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                        'url TEXT PRIMARY KEY, body BLOB NOT NULL, content_type TEXT, etag TEXT, last_modified TEXT, '
+                        'expires REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def get(self, url: str, ttl: float, send: Callable[[dict], Response]) -> Response:
+        """
+        Get response of url from the cache, or from the server if it is expired
+
+        Args:
+            url (str): url of the request, used as the cache key
+            ttl (float): seconds a response stays fresh, 0 means always revalidate
+            send (Callable[[dict], Response]): send the request with the given extra headers
+        """
+        with self.lock:
+            entry = self.db.execute('SELECT body, content_type, etag, last_modified, expires FROM responses '
+                                    'WHERE url = ?', (url,)).fetchone()
+
+        now = time.time()
+        if entry is not None:
+            body, content_type, etag, last_modified, expires = entry
+
+            if expires > now:
+                self.__touch(url, now)
+                return self.__to_response(url, body, content_type, etag, last_modified)
+
+            headers = {}
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+
+            try:
+                r = send(headers)
+            except RequestException:
+                return self.__to_response(url, body, content_type, etag, last_modified)  # <--- stale-if-error
+
+            if r.status_code == 429 or r.status_code >= 500:
+                return self.__to_response(url, body, content_type, etag, last_modified)  # <--- stale-if-error
+            if r.status_code == 304:
+                with self.lock, self.db:
+                    self.db.execute('UPDATE responses SET expires = ?, accessed = ? WHERE url = ?',
+                                    (now + ttl, now, url))
+                return self.__to_response(url, body, content_type, etag, last_modified)
+        else:
+            r = send({})
+
+        if r.status_code == 200:
+            self.__store(url, r, now + ttl, now)
+        elif entry is not None and r.status_code in GONE_STATUS:
+            self.__delete(url)  # the server no longer has what we have
+
+        return r
+
+    def clear(self) -> None:
+        """Remove all cached responses"""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM responses')
+
+    def close(self) -> None:
+        """Close the cache database"""
+        with self.lock:
+            self.db.close()
+
+    def __store(self, url: str, r: Response, expires: float, now: float) -> None:
+        """Store response, evict least recently used responses if the cache is too large"""
+        etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+        if expires <= now and etag is None and last_modified is None:
+            return  # nothing to serve or revalidate next time
+
+        body = r.content
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (url, body, r.headers.get('Content-Type'), etag, last_modified, expires, now, len(body)))
+
+            size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if size > self.max_size:
+                entries = self.db.execute('SELECT url, size FROM responses ORDER BY accessed').fetchall()
+                for old_url, old_size in entries:
+                    if size <= self.max_size:
+                        break
+                    self.db.execute('DELETE FROM responses WHERE url = ?', (old_url,))
+                    size -= old_size
+
+    def __touch(self, url: str, now: float) -> None:
+        """Mark response as recently used"""
+        with self.lock, self.db:
+            self.db.execute('UPDATE responses SET accessed = ? WHERE url = ?', (now, url))
+
+    def __delete(self, url: str) -> None:
+        """Remove response from the cache"""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+
+    @staticmethod
+    def __to_response(url: str, body: bytes, content_type: Optional[str], etag: Optional[str],
+                      last_modified: Optional[str]) -> Response:
+        """Build response from a cache entry"""
+        r = Response()
+        r.url = url
+        r.status_code = 200
+        r._content = body
+        r.encoding = 'utf-8'
+        r.headers = CaseInsensitiveDict({'Content-Type': content_type, 'ETag': etag, 'Last-Modified': last_modified})
+        for key in [key for key, value in r.headers.items() if value is None]:
+            del r.headers[key]
+
+        return r
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
@@ -0,0 +1,120 @@
+import time
+import asyncio
+import threading
+from typing import Optional
+
+# status codes telling us to slow down
+THROTTLE_STATUS = {429, 503}
+
+
+class TokenBucket(object):
+    """
+    Adaptive token bucket
+
+    The rate is halved (down to min_rate) whenever the server pushes back, and recovers additively
+    after every successful request until it reaches max_rate again.
+
+    Args:
+        rate (float): initial requests per second
+        burst (float): max number of requests sent back to back
+        min_rate (float): lowest rate after backing off
+        max_rate (float): highest rate after recovering
+    """
+    def __init__(self, rate: float, burst: float, min_rate: float, max_rate: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.step = rate * 0.05  # additive increase per successful request
+
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # set by Retry-After
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, return how long the caller has to wait before sending the request"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # tokens may go negative, later callers queue up behind earlier ones
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+            return max(wait, self.blocked_until - now)
+
+    def penalize(self, retry_after: Optional[float] = None) -> None:
+        """Back off after the server pushed back"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def reward(self) -> None:
+        """Recover gradually after a successful request"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+
+class RateLimiter(object):
+    """
+    Rate limiter with one adaptive budget per endpoint class
+
+    Every HTTP call goes through acquire() (or acquire_async()) of its endpoint class and reports
+    the response back with feedback().
+
+    Args:
+        limits (dict, optional): overrides of the default limits, endpoint class -> requests per second.
+            Defaults to None.
+    """
+    # endpoint class: (rate, burst, min_rate, max_rate)
+    DEFAULT_LIMITS = {
+        'api': (2.0, 4, 0.2, 5.0),
+        'auth': (0.5, 2, 0.1, 1.0),
+        'hls': (1.0, 3, 0.2, 4.0),
+        'segment': (100.0, 100, 1.0, 500.0),
+    }
+
+    def __init__(self, limits: Optional[dict] = None) -> None:
+        self.buckets = {}
+        for endpoint, (rate, burst, min_rate, max_rate) in self.DEFAULT_LIMITS.items():
+            if limits is not None and endpoint in limits:
+                rate = float(limits[endpoint])
+                burst, min_rate, max_rate = max(rate, 1), min(min_rate, rate), rate
+
+            self.buckets[endpoint] = TokenBucket(rate, burst, min_rate, max_rate)
+
+    def acquire(self, endpoint: str) -> None:
+        """Wait until a request of the endpoint class can be sent"""
+        wait = self.buckets[endpoint].reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, endpoint: str) -> None:
+        """Wait until a request of the endpoint class can be sent, without blocking the event loop"""
+        wait = self.buckets[endpoint].reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def feedback(self, endpoint: str, status: int, retry_after: Optional[str] = None) -> None:
+        """Adapt the rate of the endpoint class to the response"""
+        if status in THROTTLE_STATUS:
+            self.penalize(endpoint, retry_after)
+        elif status < 400:
+            self.buckets[endpoint].reward()
+
+    def penalize(self, endpoint: str, retry_after: Optional[str] = None) -> None:
+        """Back off the endpoint class, e.g. after a throttled response or an error body"""
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None  # http-date is not worth parsing here, halving the rate is enough
+
+        self.buckets[endpoint].penalize(retry_after)
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
@@ -0,0 +1,90 @@
+import time
+from typing import Optional
+
+from requests import Session, Response
+from requests.adapters import HTTPAdapter
+
+from .cache import ResponseCache
+from .rate_limiter import RateLimiter
+from util.metrics import Metrics
+
+
+class Transport(object):
+    """
+    Shared HTTP transport
+
+    A keep-alive connection pool shared by the API client, the auth flow and the segment downloaders,
+    so each host only pays the TCP+TLS handshake once per pooled connection.
+    Every request is paced by the rate limiter of its endpoint class ('api', 'auth', 'hls' or 'segment'),
+    its latency and status are recorded per endpoint name (e.g. 'video_list'), defaulting to the class.
+
+    Args:
+        headers (dict, optional): default headers sent with every request. Defaults to None.
+        pool_size (int, optional): max number of keep-alive connections per host. Defaults to 10.
+        limiter (RateLimiter, optional): rate limiter. Defaults to one with the default limits.
+        cache (ResponseCache, optional): cache of GET responses sent with a ttl. Defaults to None (no cache).
+        metrics (Metrics, optional): metrics of requests per endpoint. Defaults to disabled metrics.
+    """
+    def __init__(self, headers: Optional[dict] = None, pool_size: int = 10,
+                 limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+                 metrics: Optional[Metrics] = None) -> None:
+        self.pool_size = pool_size
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+
+        self.session = Session()
+        if headers is not None:
+            self.session.headers.update(headers)
+
+        # pool_connections is the number of host pools to cache, pool_maxsize is the size of each pool
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @property
+    def headers(self) -> dict:
+        """Default headers of the transport"""
+        return self.session.headers
+
+    def request(self, method: str, url: str, endpoint: str = 'api', name: Optional[str] = None,
+                **kwargs) -> Response:
+        """Send request through the pooled session, paced by the class endpoint and recorded as name"""
+        self.limiter.acquire(endpoint)
+        start = time.perf_counter()
+        r = self.session.request(method, url, **kwargs)
+        self.limiter.feedback(endpoint, r.status_code, r.headers.get('Retry-After'))
+
+        # streamed responses are timed up to the headers, the body is timed by the caller
+        labels = {'endpoint': name or endpoint, 'endpoint_class': endpoint}
+        self.metrics.observe('http_request_seconds', time.perf_counter() - start, **labels)
+        self.metrics.inc('http_responses_total', status=r.status_code, **labels)
+
+        return r
+
+    def get(self, url: str, endpoint: str = 'api', ttl: Optional[float] = None, name: Optional[str] = None,
+            **kwargs) -> Response:
+        """Send GET request through the pooled session, served from the cache if a ttl is given"""
+        if ttl is None or self.cache is None:
+            return self.request('GET', url, endpoint, name, **kwargs)
+
+        extra_headers = kwargs.pop('headers', None) or {}
+
+        def send(headers: dict) -> Response:
+            return self.request('GET', url, endpoint, name, headers={**extra_headers, **headers}, **kwargs)
+
+        return self.cache.get(url, ttl, send)
+
+    def post(self, url: str, data=None, endpoint: str = 'api', name: Optional[str] = None, **kwargs) -> Response:
+        """Send POST request through the pooled session"""
+        return self.request('POST', url, endpoint, name, data=data, **kwargs)
+
+    def close(self) -> None:
+        """Close all pooled connections and the cache"""
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import statistics
+import subprocess
+import multiprocessing
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
+
+import typer
+import requests
+from typing_extensions import Annotated
+
+from benchmark.server import StandInConfig, serve
+from util.options import Engine, WriteMode, DecryptMode
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# high enough to never pace the stand-in server, the engine is what we measure
+UNPACED_LIMITS = {'api': 1000.0, 'auth': 1000.0, 'hls': 1000.0, 'segment': 100000.0}
+
+app = typer.Typer(add_completion=False, help='Offline benchmarks against a local stand-in of the NCP servers.')
+
+
+class Scenario(str, Enum):
+    video = 'video'
+    channel = 'channel'
+    list = 'list'
+
+
+class StandIn(object):
+    """
+    Stand-in server running in a separate process, so it does not count towards our CPU time and memory
+
+    Args:
+        config (StandInConfig): shape of the content
+    """
+    def __init__(self, config: StandInConfig) -> None:
+        self.config = config
+        self.process = None
+        self.host = None
+
+    def __enter__(self):
+        context = multiprocessing.get_context('spawn')
+        ready = context.Queue()
+        self.process = context.Process(target=serve, args=(self.config, 0, ready), daemon=True)
+        self.process.start()
+        self.host = ready.get(timeout=60)  # encrypting the segments may take a while
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.process.terminate()
+        self.process.join()
+
+    def stats(self) -> dict:
+        """Segment samples recorded by the server since the last reset"""
+        return requests.get(f'{self.host}/_stats').json()
+
+    def reset(self) -> None:
+        """Clear the samples recorded by the server"""
+        requests.post(f'{self.host}/_reset')
+
+
+def percentile(samples: list, p: float) -> Optional[float]:
+    """Nearest-rank percentile of sorted samples"""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, max(int(round(p / 100 * len(samples))) - 1, 0))]
+
+
+def peak_rss() -> Optional[float]:
+    """Peak resident set size of this process in MiB, None where it is not available"""
+    try:
+        import resource
+    except ImportError:
+        return None  # windows
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if platform.system() == 'Darwin' else peak / 1024  # bytes on macOS, KiB on linux
+
+
+def revision() -> Optional[str]:
+    """Git revision of the tree being measured"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def size_of(path: Path) -> int:
+    """Total size of the videos under path"""
+    return sum(file.stat().st_size for file in path.rglob('*') if file.suffix in ('.ts', '.mp4'))
+
+
+@app.command()
+def run(
+        scenario: Annotated[
+            Scenario,
+            typer.Argument(
+                help='video: download one video. channel: download every video of a channel. '
+                     'list: list the videos of a channel.',
+            ),
+        ] = Scenario.video,
+        videos: Annotated[
+            int,
+            typer.Option('--videos', show_default=True, help='Videos in the channel.'),
+        ] = 4,
+        segments: Annotated[
+            int,
+            typer.Option('--segments', show_default=True, help='Segments per video.'),
+        ] = 50,
+        segment_size: Annotated[
+            int,
+            typer.Option('--segment-size', show_default=True, help='Bytes per segment.'),
+        ] = 1024 * 1024,
+        latency: Annotated[
+            float,
+            typer.Option('--latency', show_default=True, help='Milliseconds added by the server to every response.'),
+        ] = 0.0,
+        error_rate: Annotated[
+            float,
+            typer.Option('--error-rate', show_default=True, help='Probability of a segment request failing.'),
+        ] = 0.0,
+        thread: Annotated[
+            int,
+            typer.Option('--thread', show_default=True, help='Threads, or in-flight requests of the asyncio engine.'),
+        ] = 4,
+        engine: Annotated[
+            Engine,
+            typer.Option('--engine', show_default=True, help='Segment download engine.'),
+        ] = Engine.thread,
+        write_mode: Annotated[
+            WriteMode,
+            typer.Option('--write-mode', show_default=True, help='Write mode, pipe needs ffmpeg.'),
+        ] = WriteMode.temp,
+        decrypt: Annotated[
+            DecryptMode,
+            typer.Option('--decrypt', show_default=True, help='Where segments are decrypted.'),
+        ] = DecryptMode.inline,
+        parallel: Annotated[
+            int,
+            typer.Option('--parallel', show_default=True, help='Videos downloaded at once (channel scenario).'),
+        ] = 1,
+        repeat: Annotated[
+            int,
+            typer.Option('--repeat', show_default=True, help='Listings of the channel (list scenario).'),
+        ] = 20,
+        paced: Annotated[
+            bool,
+            typer.Option('--paced', show_default=False, help='Keep the default rate limits of the client.'),
+        ] = False,
+        ffmpeg: Annotated[
+            str,
+            typer.Option('--ffmpeg', help='Path to ffmpeg (pipe write mode).'),
+        ] = 'ffmpeg',
+        output: Annotated[
+            Optional[Path],
+            typer.Option('--output', '-o', show_default=False, help='Write the results to this JSON file.'),
+        ] = None,
+) -> None:
+    """Run a scenario end to end and report throughput, segment latency, peak RSS and CPU time"""
+    config = StandInConfig(videos if scenario != Scenario.video else 1, segments, segment_size, latency / 1000,
+                           error_rate)
+
+    with StandIn(config) as stand_in:
+        # the client is imported after the server is up, so its import cost is not part of the results
+        from api.api import NCP, ChannelID, ContentCode
+        from util.channel_downloader import ChannelDownloader
+        from util.decryptor import DecryptPool
+        from util.m3u8_downloader import M3U8Downloader
+        from util.progress import ProgressManager
+        from util.retry import RetryPolicy
+
+        api_client = NCP(urlparse(stand_in.host).netloc, None, None, max(10, thread),
+                         None if paced else UNPACED_LIMITS, scheme='http')
+        api_client.api_video_index = f'{stand_in.host}/hls/index.m3u8?session_id=%s'
+        progress_manager = ProgressManager()  # not rendered, the terminal is not what we measure
+        decrypt_pool = DecryptPool(decrypt.value) if decrypt != DecryptMode.inline else None
+
+        workdir = Path(tempfile.mkdtemp(prefix='ncp-benchmark-'))
+        stand_in.reset()
+        cpu_start = _cpu_times()
+        start = time.perf_counter()
+        try:
+            match scenario:
+                case Scenario.video:
+                    content_code = ContentCode('bm000000')
+                    downloader = M3U8Downloader(api_client, progress_manager, api_client.get_session_id(content_code),
+                                                str(workdir.joinpath('video')), resume=False, transcode=False,
+                                                ffmpeg=ffmpeg, thread=thread, engine=engine.value,
+                                                write_mode=write_mode.value, retry=RetryPolicy(),
+                                                content_code=content_code, decrypt_pool=decrypt_pool)
+                    ok = downloader.start()
+                case Scenario.channel:
+                    channel_id = ChannelID('1')
+                    video_list = [ContentCode(video['content_code'], video)
+                                  for video in api_client.iter_videos(channel_id)]
+                    # a directory of its own, the channel manager keeps its database next to the output
+                    downloader = ChannelDownloader(api_client, progress_manager, channel_id, video_list,
+                                                   str(workdir.joinpath('channel')), resume=False, transcode=False,
+                                                   ffmpeg=ffmpeg, thread=thread, engine=engine.value,
+                                                   write_mode=write_mode.value, parallel=parallel,
+                                                   retry=RetryPolicy(), decrypt_pool=decrypt_pool)
+                    downloader.start()
+                    # failed videos are only reported, every one of them must be marked as done
+                    ok = all(downloader.channel_manager.get_status(str(video)) is True for video in video_list)
+                case Scenario.list:
+                    ok = all(len(api_client.list_videos(ChannelID('1'))) == config.videos for _ in range(repeat))
+                case _:
+                    raise ValueError(f'Invalid scenario: {scenario}')
+
+            wall = time.perf_counter() - start
+            user, system = (end - begin for begin, end in zip(cpu_start, _cpu_times()))
+            written = size_of(workdir)
+
+            # a transcoded video has a size of its own, the others are the decrypted segments end to end
+            if scenario != Scenario.list and write_mode != WriteMode.pipe:
+                ok = ok and written == config.videos * config.video_size
+        finally:
+            if decrypt_pool is not None:
+                decrypt_pool.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        stats = stand_in.stats()
+
+    latencies = sorted(latency * 1000 for latency in stats['latencies'])
+    results = {
+        'scenario': scenario.value,
+        'ok': ok,
+        'revision': revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'config': {
+            'videos': config.videos, 'segments': segments, 'segment_size': segment_size, 'latency_ms': latency,
+            'error_rate': error_rate, 'thread': thread, 'engine': engine.value, 'write_mode': write_mode.value,
+            'decrypt': decrypt.value, 'parallel': parallel, 'repeat': repeat if scenario == Scenario.list else None,
+            'paced': paced,
+        },
+        'wall_s': round(wall, 3),
+        'bytes': written,
+        'throughput_mib_s': round(written / 1024 / 1024 / wall, 2) if wall > 0 else None,
+        'segment_requests': stats['requests'],
+        'segment_errors': stats['errors'],
+        'segment_latency_ms': {
+            'p50': _round(percentile(latencies, 50)),
+            'p99': _round(percentile(latencies, 99)),
+            'mean': _round(statistics.fmean(latencies) if latencies else None),
+        },
+        'peak_rss_mib': _round(peak_rss()),
+        'cpu_s': {'user': round(user, 3), 'system': round(system, 3)},
+    }
+
+    _write(results, output)
+    if not ok:
+        raise typer.Exit(1)
+
+
+@app.command()
+def compare(
+        baseline: Annotated[Path, typer.Argument(help='Results of the baseline run.')],
+        candidate: Annotated[Path, typer.Argument(help='Results of the run to compare.')],
+) -> None:
+    """Compare two result files, positive change means the candidate is larger"""
+    base, new = json.loads(baseline.read_text()), json.loads(candidate.read_text())
+    if base['config'] != new['config'] or base['scenario'] != new['scenario']:
+        print('warning: the runs were made with different settings', file=sys.stderr)
+
+    rows = {}
+    for key in ('wall_s', 'throughput_mib_s', 'peak_rss_mib'):
+        rows[key] = (base[key], new[key])
+    for key in ('p50', 'p99', 'mean'):
+        rows[f'segment_latency_ms.{key}'] = (base['segment_latency_ms'][key], new['segment_latency_ms'][key])
+    for key in ('user', 'system'):
+        rows[f'cpu_s.{key}'] = (base['cpu_s'][key], new['cpu_s'][key])
+
+    print(f'{"metric":<26}{"baseline":>12}{"candidate":>12}{"change":>10}')
+    for key, (old, value) in rows.items():
+        change = f'{(value - old) / old * 100:+.1f}%' if old and value is not None else '-'
+        print(f'{key:<26}{_format(old):>12}{_format(value):>12}{change:>10}')
+
+
+def _cpu_times() -> tuple:
+    """User and system CPU time of this process"""
+    times = os.times()
+    return times.user, times.system
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 3) if value is not None else None
+
+
+def _format(value) -> str:
+    return '-' if value is None else f'{value:g}'
+
+
+def _write(results: dict, output: Optional[Path]) -> None:
+    if output is not None:
+        output.write_text(json.dumps(results, indent=2))
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    app()
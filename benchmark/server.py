@@ -0,0 +1,223 @@
+import json
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.padding import PKCS7
+
+KEY = bytes(range(16))  # AES-128 key of every stand-in video
+TS_PACKET_SIZE = 188
+
+
+class StandInConfig(object):
+    """
+    Shape of the content served by the stand-in server
+
+    Args:
+        videos (int, optional): number of videos in the channel. Defaults to 1.
+        segments (int, optional): number of segments per video. Defaults to 50.
+        segment_size (int, optional): bytes per segment before encryption. Defaults to 1 MiB.
+        latency (float, optional): seconds added before every response. Defaults to 0.
+        error_rate (float, optional): probability of a segment request failing with 500. Defaults to 0.
+        max_per_page (int, optional): max page size of the video list. Defaults to 100.
+    """
+    def __init__(self, videos: int = 1, segments: int = 50, segment_size: int = 1024 * 1024, latency: float = 0.0,
+                 error_rate: float = 0.0, max_per_page: int = 100) -> None:
+        self.videos = videos
+        self.segments = segments
+        self.segment_size = segment_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_per_page = max_per_page
+
+    @property
+    def packets(self) -> int:
+        """MPEG-TS packets per segment"""
+        return max(self.segment_size // TS_PACKET_SIZE, 1)
+
+    @property
+    def video_size(self) -> int:
+        """Bytes of a downloaded video (decrypted, before transcoding)"""
+        return self.segments * self.packets * TS_PACKET_SIZE
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Local HTTP server posing as the NCP API, the hls-auth index and an AES-128 encrypted HLS stream
+
+    Every video shares the same segments, they are encrypted once at startup so serving them costs no CPU.
+    The time from receiving a segment request to writing its last byte is recorded, /_stats returns the samples
+    and POST /_reset clears them.
+
+    Args:
+        config (StandInConfig): shape of the content
+        port (int, optional): port to listen on. Defaults to 0 (any free port).
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, config: StandInConfig, port: int = 0) -> None:
+        super().__init__(('127.0.0.1', port), StandInHandler)
+        self.config = config
+        self.host = f'http://127.0.0.1:{self.server_port}'
+
+        # segments are valid mpeg-ts packets (sync byte 0x47) so they can also be fed to ffmpeg
+        self.plain_segments = [(bytes([0x47, 0x1f, 0xff, 0x10]) + bytes([i % 256]) * (TS_PACKET_SIZE - 4))
+                               * config.packets
+                               for i in range(config.segments)]
+        self.segments = [self.__encrypt(segment, sequence) for sequence, segment in enumerate(self.plain_segments)]
+
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, latency: float, error: bool) -> None:
+        """Record a served segment request"""
+        with self.lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            else:
+                self.latencies.append(latency)
+
+    def stats(self) -> dict:
+        """Samples recorded since the last reset"""
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors, 'latencies': list(self.latencies)}
+
+    def reset(self) -> None:
+        """Clear recorded samples"""
+        with self.lock:
+            self.latencies.clear()
+            self.requests = 0
+            self.errors = 0
+
+    def video(self, index: int) -> dict:
+        """Video page of the video at index, newest first like the real listing"""
+        return {
+            'content_code': f'bm{index:06d}',
+            'title': f'Benchmark video {index}',
+            'released_at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1700000000 - index * 86400)),
+        }
+
+    @staticmethod
+    def __encrypt(data: bytes, media_sequence: int) -> bytes:
+        padder = PKCS7(128).padder()
+        encryptor = Cipher(algorithms.AES(KEY), modes.CBC(media_sequence.to_bytes(16, 'big'))).encryptor()
+
+        return encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Request handler of StandInServer"""
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real servers
+    server: StandInServer
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        config = self.server.config
+
+        if parts[0] == '_stats':
+            return self.__send_json(self.server.stats())
+
+        if config.latency > 0:
+            time.sleep(config.latency)
+
+        match parts:
+            case ['site', 'settings.json']:
+                self.__send_json({'api_base_url': f'{self.server.host}/fc', 'fanclub_site_id': '1',
+                                  'platform_id': 'benchmark'})
+            case ['fc', 'fanclub_sites', _, 'login']:
+                self.__send_json({'data': {'fanclub_site': {'auth0_web_client_id': 'benchmark',
+                                                            'fanclub_group': {'auth0_domain': '127.0.0.1'}}}})
+            case ['fc', 'fanclub_sites', site_id, 'page_base_info']:
+                self.__send_json({'data': {'fanclub_site': {'fanclub_site_name': f'Benchmark channel {site_id}'}}})
+            case ['fc', 'fanclub_sites', _, 'video_pages']:
+                query = parse_qs(url.query)
+                page = int(query.get('page', ['1'])[0])
+                per_page = min(int(query.get('per_page', ['12'])[0]), config.max_per_page)
+                videos = [self.server.video(index)
+                          for index in range((page - 1) * per_page, min(page * per_page, config.videos))]
+                self.__send_json({'data': {'video_pages': {'list': videos, 'total': config.videos}}})
+            case ['fc', 'video_pages', content_code]:
+                self.__send_json({'data': {'video_page': self.server.video(int(content_code[2:]))}})
+            case ['fc', 'video_pages', content_code, 'public_status']:
+                self.__send_json({'data': {'video_page': self.server.video(int(content_code[2:]))}})
+            case ['hls', 'index.m3u8']:
+                session_id = parse_qs(url.query).get('session_id', [''])[0]
+                self.__send(f'#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=4000000,RESOLUTION=1920x1080\n'
+                            f'{self.server.host}/hls/{session_id}/video.m3u8\n'.encode(), 'application/x-mpegURL')
+            case ['hls', session_id, 'video.m3u8']:
+                segments = ''.join(f'#EXTINF:6.0,\n{self.server.host}/hls/{session_id}/{i}.ts\n'
+                                   for i in range(config.segments))
+                self.__send(('#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:6\n#EXT-X-MEDIA-SEQUENCE:0\n'
+                             f'#EXT-X-KEY:METHOD=AES-128,URI="{self.server.host}/hls/key"\n'
+                             f'{segments}#EXT-X-ENDLIST\n').encode(), 'application/x-mpegURL')
+            case ['hls', 'key']:
+                self.__send(KEY, 'application/octet-stream')
+            case ['hls', _, segment] if segment.endswith('.ts'):
+                if config.error_rate > 0 and random.random() < config.error_rate:
+                    self.__send(b'', 'text/plain', 500)
+                    self.server.record(time.perf_counter() - start, True)
+                    return
+                self.__send(self.server.segments[int(segment[:-3])], 'video/MP2T')
+                self.server.record(time.perf_counter() - start, False)
+            case _:
+                self.__send(b'', 'text/plain', 404)
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        parts = urlparse(self.path).path.strip('/').split('/')
+
+        if parts[0] == '_reset':
+            self.server.reset()
+            return self.__send_json({})
+
+        if self.server.config.latency > 0:
+            time.sleep(self.server.config.latency)
+
+        match parts:
+            case ['fc', 'video_pages', content_code, 'session_ids']:
+                self.__send_json({'data': {'session_id': f'session-{content_code}'}})
+            case _:
+                self.__send(b'', 'text/plain', 404)
+
+    def __send_json(self, data: dict) -> None:
+        self.__send(json.dumps(data).encode(), 'application/json')
+
+    def __send(self, body: bytes, content_type: str, status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(config: StandInConfig, port: int = 0, ready=None) -> None:
+    """
+    Run the stand-in server until the process is terminated, meant to be the target of a separate process
+    so the server does not count towards the CPU time and memory of the benchmark
+
+    Args:
+        config (StandInConfig): shape of the content
+        port (int, optional): port to listen on. Defaults to 0 (any free port).
+        ready (multiprocessing.Queue, optional): receives the base url once the server is listening. Defaults to None.
+    """
+    server = StandInServer(config, port)
+    if ready is not None:
+        ready.put(server.host)
+
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
@@ -0,0 +1,97 @@
+import sys
+import json
+import time
+import shutil
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+import typer
+from typing_extensions import Annotated
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# invocations that never reach the network, what a scheduler pays before any real work starts
+CASES = {
+    'help': ['--help'],
+    'usage_error': [],
+}
+
+
+def measure(main_py: Path, args: list, runs: int) -> dict:
+    """Run main.py with args runs times, return wall time statistics in milliseconds"""
+    command = [sys.executable, str(main_py), *args]
+    subprocess.run(command, cwd=main_py.parent, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)  # warm up
+
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=main_py.parent, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append((time.perf_counter() - start) * 1000)
+
+    samples.sort()
+    return {
+        'runs': runs,
+        'min_ms': round(samples[0], 2),
+        'p50_ms': round(statistics.median(samples), 2),
+        'p90_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.9))], 2),
+    }
+
+
+def measure_tree(root: Path, runs: int) -> dict:
+    """Measure every case against main.py of root"""
+    return {name: measure(root.joinpath('main.py'), args, runs) for name, args in CASES.items()}
+
+
+def main(
+        runs: Annotated[
+            int,
+            typer.Option(
+                '--runs',
+                show_default=True,
+                help='Invocations per case.',
+            ),
+        ] = 20,
+        baseline: Annotated[
+            Optional[str],
+            typer.Option(
+                '--baseline',
+                show_default=False,
+                help='Git revision to compare against, e.g. HEAD~1. It is checked out into a temporary worktree.',
+            ),
+        ] = None,
+        output: Annotated[
+            Optional[Path],
+            typer.Option(
+                '--output', '-o',
+                show_default=False,
+                help='Write the results to this JSON file instead of stdout.',
+            ),
+        ] = None,
+) -> None:
+    """Measure CLI startup time"""
+    results = {'python': sys.version.split()[0], 'current': measure_tree(ROOT, runs)}
+
+    if baseline is not None:
+        worktree = Path(tempfile.mkdtemp(prefix='ncp-startup-'))
+        try:
+            subprocess.run(['git', 'worktree', 'add', '--detach', str(worktree), baseline], cwd=ROOT, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            results['baseline'] = {'revision': baseline, **measure_tree(worktree, runs)}
+            results['gain_p50_ms'] = {name: round(results['baseline'][name]['p50_ms'] - stats['p50_ms'], 2)
+                                      for name, stats in results['current'].items()}
+        finally:
+            subprocess.run(['git', 'worktree', 'remove', '--force', str(worktree)], cwd=ROOT,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            shutil.rmtree(worktree, ignore_errors=True)
+
+    if output is not None:
+        output.write_text(json.dumps(results, indent=2))
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -2,21 +2,16 @@ import sys
 import platform
 
 import click
-import inquirer
 import typer
 from typing_extensions import Annotated
 from typing import Optional
-from urllib.parse import urlparse, urlunparse
+from urllib.parse import urlparse
 from pathlib import Path
-import pylibimport
 
-from api.api import NCP, ContentCode
-from util.ffmpeg import FFMPEG
-from util.m3u8_downloader import M3U8Downloader
-from util.channel_downloader import ChannelDownloader
-from util.progress import ProgressManager
+from util.options import Engine, WriteMode, DecryptMode, parse_resolution
 
-__import__('util.inquirer_console_render')  # hook for inquirer console render
+# everything else (inquirer, rich, m3u8, cryptography, the api client...) is imported in main,
+# so --help and invalid arguments don't pay for it
 
 
 class Resolution(click.ParamType):
@@ -24,14 +19,27 @@ class Resolution(click.ParamType):
 
     def convert(self, value, param, ctx):
         try:
-            resolution = tuple(map(int, value.split('x')))
-            if len(resolution) != 2:
-                raise ValueError
-            return resolution
+            return parse_resolution(value)
         except ValueError:
             self.fail(f'Invalid resolution: {value}.', param, ctx)
 
 
+class RateLimits(click.ParamType):
+    name = 'Rate Limits'
+
+    def convert(self, value, param, ctx):
+        try:
+            limits = {}
+            for item in value.split(','):
+                endpoint, rate = item.split('=')
+                if endpoint.strip() not in ('api', 'auth', 'hls', 'segment') or float(rate) <= 0:
+                    raise ValueError
+                limits[endpoint.strip()] = float(rate)
+            return limits
+        except ValueError:
+            self.fail(f'Invalid rate limits: {value}.', param, ctx)
+
+
 class FFMPEGOptions(click.ParamType):
     name = 'FFMPEG Options'
 
@@ -129,6 +137,85 @@ def main(
                 help='Number of threads for downloading. (NOT RECOMMENDED TO EDIT)',
             ),
         ] = 1,
+        pool_size: Annotated[
+            int,
+            typer.Option(
+                '--pool-size',
+                show_default=True,
+                help='Max number of keep-alive connections per host. Raised to --thread if lower.',
+            ),
+        ] = 10,
+        rate_limit: Annotated[
+            RateLimits,
+            typer.Option(
+                '--rate-limit',
+                show_default=False,
+                help='Requests per second of each endpoint class, e.g. "api=2,hls=1,segment=50". '
+                     'Defaults to adaptive limits that back off when the server pushes back.',
+                click_type=RateLimits(),
+            ),
+        ] = None,
+        engine: Annotated[
+            Engine,
+            typer.Option(
+                '--engine',
+                show_default=True,
+                help='Segment download engine. asyncio keeps --thread requests in flight on a single thread.',
+            ),
+        ] = Engine.thread,
+        retries: Annotated[
+            int,
+            typer.Option(
+                '--retries',
+                show_default=True,
+                help='Max attempts per segment before it is left for the next round.',
+            ),
+        ] = 5,
+        write_mode: Annotated[
+            WriteMode,
+            typer.Option(
+                '--write-mode',
+                show_default=True,
+                help='temp: one temp file per segment, concatenated at the end. '
+                     'direct: write segments straight into the output file in order. '
+                     'pipe: feed segments into ffmpeg while downloading (implies --transcode).',
+            ),
+        ] = WriteMode.temp,
+        verify_checksum: Annotated[
+            bool,
+            typer.Option(
+                '--verify-checksum',
+                show_default=False,
+                help='When resuming, compare the checksum of every segment already downloaded. '
+                     'Sizes and MPEG-TS sync bytes are always checked.',
+            ),
+        ] = False,
+        decrypt: Annotated[
+            DecryptMode,
+            typer.Option(
+                '--decrypt',
+                show_default=True,
+                help='inline: decrypt on the download workers. thread: on a dedicated thread pool. '
+                     'process: in worker processes, for links fast enough to be bound by the CPU.',
+            ),
+        ] = DecryptMode.inline,
+        decrypt_workers: Annotated[
+            Optional[int],
+            typer.Option(
+                '--decrypt-workers',
+                show_default=False,
+                help='Number of decrypt workers. Defaults to the number of CPUs.',
+            ),
+        ] = None,
+        parallel: Annotated[
+            int,
+            typer.Option(
+                '--parallel',
+                show_default=True,
+                help='Number of videos downloaded at once when downloading the whole channel. '
+                     'They share the --thread in-flight segment requests.',
+            ),
+        ] = 1,
         select_manually: Annotated[
             bool,
             typer.Option(
@@ -137,6 +224,72 @@ def main(
                 help='Manually select videos to download. Only works when downloading the whole channel.',
             ),
         ] = False,
+        incremental: Annotated[
+            bool,
+            typer.Option(
+                '--incremental',
+                show_default=False,
+                help='Only list the videos of the channel newer than the last run of the task, '
+                     'with a full listing every --full-sync-interval hours.',
+            ),
+        ] = False,
+        full_sync_interval: Annotated[
+            float,
+            typer.Option(
+                '--full-sync-interval',
+                show_default=True,
+                help='Hours between two full listings of the channel with --incremental.',
+            ),
+        ] = 24,
+        metrics_textfile: Annotated[
+            Optional[Path],
+            typer.Option(
+                '--metrics-textfile',
+                show_default=False,
+                help='Write per-stage timings and counters as a Prometheus textfile when the run ends.',
+            ),
+        ] = None,
+        metrics_json: Annotated[
+            Optional[Path],
+            typer.Option(
+                '--metrics-json',
+                show_default=False,
+                help='Write per-stage timings and counters as a JSON summary when the run ends.',
+            ),
+        ] = None,
+        profile: Annotated[
+            Optional[Path],
+            typer.Option(
+                '--profile',
+                show_default=False,
+                help='Profile CPU time (every thread) and allocations, write the results to this directory.',
+            ),
+        ] = None,
+        refresh_rate: Annotated[
+            float,
+            typer.Option(
+                '--refresh-rate',
+                show_default=True,
+                help='Progress refreshes per second, without a terminal a status line is logged every 10 seconds.',
+            ),
+        ] = 10,
+        no_cache: Annotated[
+            bool,
+            typer.Option(
+                '--no-cache',
+                show_default=False,
+                help='Do not read or write the API metadata cache (kept in the .cache directory of the output).',
+            ),
+        ] = False,
+        patch_dir: Annotated[
+            Optional[Path],
+            typer.Option(
+                '--patch-dir',
+                envvar='NCP_PATCH_DIR',
+                show_default=False,
+                help='Directory of patches (.so or .pyd) to load before downloading.',
+            ),
+        ] = None,
         username: Annotated[
             str,
             typer.Option(
@@ -161,19 +314,44 @@ def main(
         ] = False,
 ) -> None:
     """The NCP Downloader"""
-    # Initialize NCP API client and progress manager
-    api_client = NCP(urlparse(query).netloc, username, password)
-    progress_manager = ProgressManager()
+    if patch_dir is not None:
+        load_patch(patch_dir)  # load patches before anything they may patch is imported
 
-    try:
-        # check ffmpeg if transcode is enabled
-        if transcode and not FFMPEG(ffmpeg).check():
-            raise FileNotFoundError('ffmpeg not found.')
+    import inquirer
+    from api.api import NCP
+    from api.cache import ResponseCache
+    from util.job import JobOptions, run_job
+    from util.decryptor import DecryptPool
+    from util.progress import ProgressManager
+    from util.metrics import Metrics
+    from util.profiler import Profiler
+
+    __import__('util.inquirer_console_render')  # hook for inquirer console render
+
+    profiler = Profiler(profile) if profile is not None else None
+    if profiler is not None:
+        profiler.start()
+
+    # Initialize NCP API client (no request is sent until it is used) and progress manager
+    cache = ResponseCache(Path(output).joinpath('.cache', 'api.sqlite')) if not no_cache else None
+    metrics = Metrics(enabled=metrics_textfile is not None or metrics_json is not None)
+    api_client = NCP(urlparse(query).netloc, username, password, max(pool_size, thread), rate_limit, cache,
+                     metrics=metrics)
+    progress_manager = ProgressManager(refresh_per_second=max(refresh_rate, 0.1))
+    decrypt_pool = DecryptPool(decrypt.value, decrypt_workers) if decrypt != DecryptMode.inline else None
 
+    try:
         # if yes is enabled, skip all confirmation
         if yes:
             resume = yes
 
+        options = JobOptions(resolution, resume, transcode, ffmpeg, vcodec, acodec, ffmpeg_options, thread,
+                             engine.value, write_mode.value, parallel, retries, select_manually, verify_checksum,
+                             incremental, full_sync_interval)
+
+        # check ffmpeg if transcode is enabled
+        options.check()
+
         # tell user multithreading is dengerous
         # can not be skipped by --yes
         if thread > 1:
@@ -187,48 +365,7 @@ def main(
                 if question['thread'] == 'No':
                     raise RuntimeError('Aborted.')
 
-        # Check if query is channel or video
-        if api_client.get_channel_id(query) is None:
-            # Get video information
-            channel_query = urlparse(query).path.strip('/').split('/')[0]
-            channel_query = str(urlunparse(urlparse(query)._replace(path=f'/{channel_query}')))
-            channel_id = api_client.get_channel_id(channel_query)
-            channel_name = api_client.get_channel_info(channel_id)['fanclub_site_name']
-
-            # Get video session id
-            query = urlparse(query).path.strip('/').split('/')[-1]
-            session_id = api_client.get_session_id(ContentCode(query))
-
-            # Check if video exists
-            if session_id is None:
-                raise ValueError('Video not found or permission denied.')
-
-            output_name, _ = api_client.get_video_name(ContentCode(query))
-
-            output = str(Path(output).joinpath(channel_name).joinpath(output_name))
-
-            with progress_manager:
-                m3u8_downloader = M3U8Downloader(api_client, progress_manager, session_id, output, resolution, resume,
-                                                 transcode, ffmpeg, vcodec, acodec, ffmpeg_options, thread)
-                if not m3u8_downloader.start():
-                    raise RuntimeError('Failed to download video.')
-        else:
-            # Get channel infomation
-            channel_id = api_client.get_channel_id(query)
-            channel_name = api_client.get_channel_info(channel_id)['fanclub_site_name']
-
-            # Get video list
-            video_list = api_client.list_videos(channel_id)
-            video_list = [ContentCode(video['content_code']) for video in video_list]
-
-            output = str(Path(output).joinpath(channel_name))
-
-            with progress_manager:
-                channel_downloader = ChannelDownloader(api_client, progress_manager, channel_id, video_list, output,
-                                                       resolution, resume,
-                                                       transcode, ffmpeg, vcodec, acodec, ffmpeg_options,
-                                                       thread, select_manually)
-                channel_downloader.start()
+        run_job(api_client, progress_manager, query, output, options, decrypt_pool)
     except Exception as e:
         # Raise exception again if debug is enabled
         if debug:
@@ -237,22 +374,231 @@ def main(
         else:
             progress_manager.live.console.print(f'{e}', style='red')
             sys.exit(1)
+    finally:
+        if decrypt_pool is not None:
+            decrypt_pool.close()
+
+        # exported even if the run failed, a failed run is what we want to look into
+        if metrics_textfile is not None:
+            metrics.write_textfile(metrics_textfile)
+        if metrics_json is not None:
+            metrics.write_json(metrics_json)
+        if profiler is not None:
+            profiler.stop()
+
+
+def serve(
+        spool: Annotated[
+            Path,
+            typer.Argument(
+                help='Spool directory the jobs are read from.',
+            ),
+        ],
+        output: Annotated[
+            str,
+            typer.Argument(
+                help='Output directory of jobs that do not have their own.',
+            ),
+        ] = 'output',
+        pool_size: Annotated[
+            int,
+            typer.Option(
+                '--pool-size',
+                show_default=True,
+                help='Max number of keep-alive connections per host.',
+            ),
+        ] = 10,
+        rate_limit: Annotated[
+            RateLimits,
+            typer.Option(
+                '--rate-limit',
+                show_default=False,
+                help='Requests per second of each endpoint class, e.g. "api=2,hls=1,segment=50". '
+                     'Defaults to adaptive limits that back off when the server pushes back.',
+                click_type=RateLimits(),
+            ),
+        ] = None,
+        poll_interval: Annotated[
+            float,
+            typer.Option(
+                '--poll-interval',
+                show_default=True,
+                help='Seconds between two looks at an empty queue.',
+            ),
+        ] = 5.0,
+        exit_when_empty: Annotated[
+            bool,
+            typer.Option(
+                '--exit-when-empty',
+                show_default=False,
+                help='Exit once the queue is empty instead of waiting for new jobs.',
+            ),
+        ] = False,
+        decrypt: Annotated[
+            DecryptMode,
+            typer.Option(
+                '--decrypt',
+                show_default=True,
+                help='inline: decrypt on the download workers. thread: on a dedicated thread pool. '
+                     'process: in worker processes, for links fast enough to be bound by the CPU.',
+            ),
+        ] = DecryptMode.inline,
+        decrypt_workers: Annotated[
+            Optional[int],
+            typer.Option(
+                '--decrypt-workers',
+                show_default=False,
+                help='Number of decrypt workers. Defaults to the number of CPUs.',
+            ),
+        ] = None,
+        metrics_textfile: Annotated[
+            Optional[Path],
+            typer.Option(
+                '--metrics-textfile',
+                show_default=False,
+                help='Rewrite per-stage timings and counters of every job as a Prometheus textfile after each job.',
+            ),
+        ] = None,
+        no_cache: Annotated[
+            bool,
+            typer.Option(
+                '--no-cache',
+                show_default=False,
+                help='Do not read or write the API metadata cache (kept in the .cache directory of the output).',
+            ),
+        ] = False,
+        patch_dir: Annotated[
+            Optional[Path],
+            typer.Option(
+                '--patch-dir',
+                envvar='NCP_PATCH_DIR',
+                show_default=False,
+                help='Directory of patches (.so or .pyd) to load before downloading.',
+            ),
+        ] = None,
+        username: Annotated[
+            str,
+            typer.Option(
+                '--username',
+                help='Username for login.',
+            ),
+        ] = None,
+        password: Annotated[
+            str,
+            typer.Option(
+                '--password',
+                help='Password for login.',
+            ),
+        ] = None,
+) -> None:
+    """Run the download jobs of a spool directory, keeping the API client of each site warm between jobs"""
+    if patch_dir is not None:
+        load_patch(patch_dir)  # load patches before anything they may patch is imported
+
+    from api.cache import ResponseCache
+    from util.daemon import Daemon
+    from util.decryptor import DecryptPool
+    from util.metrics import Metrics
+    from util.spool import Spool
+
+    cache = ResponseCache(Path(output).joinpath('.cache', 'api.sqlite')) if not no_cache else None
+    metrics = Metrics(enabled=metrics_textfile is not None)
+    decrypt_pool = DecryptPool(decrypt.value, decrypt_workers) if decrypt != DecryptMode.inline else None
+
+    try:
+        failed = Daemon(Spool(spool), output, username, password, pool_size, rate_limit, cache, metrics,
+                        decrypt_pool, poll_interval, exit_when_empty, metrics_textfile).run()
+    finally:
+        if decrypt_pool is not None:
+            decrypt_pool.close()
+
+    if failed:
+        sys.exit(1)
 
 
-def load_patch():
-    # find all the .pyd(win) or .so(linux and macos), files in the current directory
+def enqueue(
+        spool: Annotated[
+            Path,
+            typer.Argument(
+                help='Spool directory of the queue.',
+            ),
+        ],
+        query: Annotated[
+            str,
+            typer.Argument(
+                help='URL to be queried.',
+            ),
+        ],
+        output: Annotated[
+            Optional[str],
+            typer.Argument(
+                show_default=False,
+                help='Output directory. Defaults to the output directory of the queue.',
+            ),
+        ] = None,
+        priority: Annotated[
+            int,
+            typer.Option(
+                '--priority', '-p',
+                show_default=True,
+                help='Jobs with a higher priority run first.',
+            ),
+        ] = 0,
+        option: Annotated[
+            Optional[list[str]],
+            typer.Option(
+                '--option', '-o',
+                show_default=False,
+                help='Download option of the job as NAME=VALUE, named like the options of a single download '
+                     '(e.g. -o thread=2 -o write_mode=direct -o resolution=1920x1080). Values are read as JSON '
+                     'when they can be.',
+            ),
+        ] = None,
+) -> None:
+    """Add a download job to the queue of a spool directory"""
+    import json
+    from util.job import JobOptions
+    from util.spool import Spool
+
+    options = {}
+    for item in option or []:
+        name, _, value = item.partition('=')
+        try:
+            options[name.strip()] = json.loads(value)
+        except ValueError:
+            options[name.strip()] = value
+
+    try:
+        JobOptions.from_dict(options)  # <--- refuse a job that can only fail
+    except (ValueError, TypeError) as e:
+        raise typer.BadParameter(str(e), param_hint='--option')
+
+    print(Spool(spool).submit(query, output, priority, options))
+
+
+def load_patch(patch_dir: Path):
+    import pylibimport
+
+    # find all the .pyd(win) or .so(linux and macos), files in the patch directory
     if platform.system() == 'Windows':
-        patches = Path('.').glob('*.pyd')
+        patches = patch_dir.glob('*.pyd')
     elif platform.system() == 'Linux' or platform.system() == 'Darwin':
-        patches = Path('.').glob('*.so')
+        patches = patch_dir.glob('*.so')
     else:
         raise RuntimeError('Unsupported platform.')
 
     # import all the .pyd or .so files
     for patch in patches:
-        pylibimport.import_module(patch.stem)
+        pylibimport.import_module(str(patch))
+
+
+# commands besides the default download, `ncp serve ...` and `ncp enqueue ...`
+COMMANDS = {'serve': serve, 'enqueue': enqueue}
 
 
 if __name__ == "__main__":
-    load_patch()  # load patches
-    typer.run(main)
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        command = COMMANDS[sys.argv.pop(1)]
+        typer.run(command)
+    else:
+        typer.run(main)
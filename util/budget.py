@@ -0,0 +1,102 @@
+import asyncio
+import threading
+from collections import deque
+
+
+class ConcurrencyBudget(object):
+    """
+    Global budget of in-flight segment requests
+
+    Shared by every downloader of a run, so several videos downloading at once never have more than
+    `size` segment requests in flight together. Works as a context manager for worker threads and as an
+    async context manager for the asyncio engine.
+
+    Slots are handed out first come, first served: a released slot goes straight to the oldest waiter, a thread
+    waiting on an event or a coroutine waiting on a future of its own loop, so nobody polls for a free slot.
+
+    Args:
+        size (int): max number of requests in flight
+    """
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.available = size
+        self.waiters = deque()  # threading.Event of waiting threads, (loop, future) of waiting coroutines
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            if self.available > 0 and not self.waiters:
+                self.available -= 1
+                return
+
+            event = threading.Event()
+            self.waiters.append(event)
+
+        event.wait()  # <--- the slot is handed over by release()
+
+    def release(self) -> None:
+        with self.lock:
+            while self.waiters:
+                waiter = self.waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self.__hand_over, future)
+                    return
+                except RuntimeError:
+                    continue  # <--- the loop is closed, nobody is waiting there anymore
+
+            if self.available >= self.size:
+                raise ValueError('Budget released too many times.')
+            self.available += 1
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.available > 0 and not self.waiters:
+                self.available -= 1
+                return self
+
+            future = loop.create_future()
+            self.waiters.append((loop, future))
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.lock:
+                try:
+                    self.waiters.remove((loop, future))
+                    waiting = True
+                except ValueError:
+                    waiting = False  # <--- the slot is already on its way to us
+
+            # handed over before the cancellation, pass it on (a cancelled future is passed on by __hand_over)
+            if not waiting and future.done() and not future.cancelled():
+                self.release()
+            raise
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __hand_over(self, future: asyncio.Future) -> None:
+        """Give a released slot to a waiting coroutine, run in the loop of the coroutine"""
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
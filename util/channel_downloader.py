@@ -1,8 +1,14 @@
+import time
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import inquirer
 
-from api.api import NCP, ChannelID
+from api.api import NCP, ChannelID, ContentCode
+from util.budget import ConcurrencyBudget
+from util.decryptor import DecryptPool
 from util.m3u8_downloader import M3U8Downloader
 from util.manager import ChannelManager
+from util.retry import RetryPolicy
 from util.progress import ProgressManager
 
 
@@ -14,7 +20,7 @@ class ChannelDownloader(object):
         api_client (NCP): NCP object
         progress_manager (ProgressManager): progress manager
         channel_id (ChannelID): channel id
-        video_list (list): list of video id
+        video_list (list): list of video id, None to let the channel manager list the channel
         output (str): output directory
         target_resolution (tuple, optional): target resolution of video. Defaults to None.
         resume (bool, optional): resume download. Defaults to None.
@@ -23,12 +29,27 @@ class ChannelDownloader(object):
         vcodec (str, optional): video codec. Defaults to 'copy'.
         acodec (str, optional): audio codec. Defaults to 'copy'.
         ffmpeg_options (list, optional): ffmpeg options. Defaults to None.
-        wait (float, optional): wait time between each request(exclude download). Defaults to 1.
+        engine (str, optional): segment download engine, 'thread' or 'asyncio'. Defaults to 'thread'.
+        write_mode (str, optional): 'temp', 'direct' or 'pipe', see M3U8Downloader. Defaults to 'temp'.
+        parallel (int, optional): number of videos downloaded at once, sharing `thread` in-flight segment requests.
+            Defaults to 1.
+        retry (RetryPolicy, optional): retry policy of segments. Defaults to RetryPolicy().
+        decrypt_pool (DecryptPool, optional): pool decrypting segments of every video, see M3U8Downloader.
+            Defaults to None.
+        verify_checksum (bool, optional): compare checksums of resumed segments, see M3U8Downloader.
+            Defaults to False.
+        incremental (bool, optional): without a video list, only list the videos newer than the last sync,
+            see ChannelManager. Defaults to False.
+        full_sync_interval (float, optional): seconds between two full listings of an incremental sync.
+            Defaults to 24 hours.
     """
     def __init__(self, api_client: NCP, progress_manager: ProgressManager, channel_id: ChannelID, video_list: list,
                  output: str, target_resolution: tuple = None, resume: bool = None, transcode: bool = None,
                  ffmpeg: str = 'ffmpeg', vcodec: str = 'copy', acodec: str = 'copy', ffmpeg_options: list = None,
-                 thread: int = 1, select_manually: bool = False, wait: float = 1) -> None:
+                 thread: int = 1, select_manually: bool = False, engine: str = 'thread',
+                 write_mode: str = 'temp', parallel: int = 1, retry: RetryPolicy = None,
+                 decrypt_pool: DecryptPool = None, verify_checksum: bool = False, incremental: bool = False,
+                 full_sync_interval: float = 24 * 3600) -> None:
         # args
         self.api_client = api_client
         self.progress_manager = progress_manager
@@ -44,11 +65,20 @@ class ChannelDownloader(object):
         self.ffmpeg_options = ffmpeg_options
         self.thread = thread
         self.select_manually = select_manually
-        self.wait = wait
+        self.engine = engine
+        self.write_mode = write_mode
+        self.parallel = parallel
+        self.retry = retry
+        self.decrypt_pool = decrypt_pool
+        self.verify_checksum = verify_checksum
+
+        # every video shares one budget of in-flight segment requests
+        self.budget = ConcurrencyBudget(self.thread)
+        self.metrics = self.api_client.transport.metrics
 
         # init manager
         self.channel_manager = ChannelManager(self.api_client, self.output, self.select_manually, self.progress_manager,
-                                              self.wait, self.resume)
+                                              self.resume, self.channel_id, incremental, full_sync_interval)
 
         # init task progress
         self.task = self.progress_manager.add_overall_task('Starting', total=None)
@@ -63,6 +93,7 @@ class ChannelDownloader(object):
         self.progress_manager.overall_reset(self.task, description='Initializing')
 
         done, total = self.channel_manager.init_manager(self.video_list, self.task)
+        self.video_list = self.channel_manager.video_list
 
         self.progress_manager.overall_update(self.task, completed=done, total=total)
 
@@ -72,33 +103,70 @@ class ChannelDownloader(object):
         # we have set done and total in __init_manager, so we don't reset channel_progress here
         self.progress_manager.overall_update(self.task, description='Overall Progress')
 
-        for video in self.video_list:
-            # skip if video is already downloaded or status is None (not selected)
-            if self.channel_manager.get_status(str(video)) or self.channel_manager.get_status(str(video)) is None:
-                continue
-
-            session_id = self.api_client.get_session_id(video)
-
-            if session_id is None:
+        # skip if video is already downloaded or status is None (not selected)
+        pending = [video for video in self.video_list if self.channel_manager.get_status(str(video)) is False]
+
+        if self.parallel <= 1:
+            for video in pending:
+                self.__download_video(video)
+            return
+
+        # concurrent downloads can not prompt on their own, so ask once before starting
+        if self.transcode is None:
+            with self.progress_manager.pause():
+                self.transcode = True if inquirer.prompt([
+                    inquirer.List('transcode', message='Do you want to transcode the videos?',
+                                  choices=['Yes', 'No'], default='Yes')
+                ], raise_keyboard_interrupt=True)['transcode'] == 'Yes' else False
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            futures = [executor.submit(self.__download_video, video) for video in pending]
+
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except KeyboardInterrupt:
                 self.progress_manager.live.console.print(
-                    f'Video [bold white]{video}[/bold white] not found or permission denied. Skip.', style='yellow')
-                continue
-
-            output_name, _ = self.api_client.get_video_name(video, self.channel_manager.get_title(str(video)))
-            output = str(Path(self.output).joinpath(f'{output_name}'))
-
-            m3u8_downloader = M3U8Downloader(self.api_client, self.progress_manager, session_id, output,
-                                             self.target_resolution, self.channel_manager.continue_exists_video,
-                                             self.transcode, self.ffmpeg, self.vcodec, self.acodec, self.ffmpeg_options,
-                                             self.thread)
+                    'got your interrupt request, hold on... do not press ctrl+c again', style='bold red on white')
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise KeyboardInterrupt
+
+    def __download_video(self, video: ContentCode) -> None:
+        """Download a video and record its status"""
+        start = time.perf_counter()
+        session_id = self.api_client.get_session_id(video)
+
+        if session_id is None:
+            self.progress_manager.live.console.print(
+                f'Video [bold white]{video}[/bold white] not found or permission denied. Skip.', style='yellow')
+            self.metrics.inc('videos_total', result='skipped')
+            return
+
+        output_name, _ = self.api_client.get_video_name(video, self.channel_manager.get_title(str(video)))
+        output = str(Path(self.output).joinpath(f'{output_name}'))
+
+        m3u8_downloader = M3U8Downloader(self.api_client, self.progress_manager, session_id, output,
+                                         self.target_resolution, self.channel_manager.continue_exists_video,
+                                         self.transcode, self.ffmpeg, self.vcodec, self.acodec, self.ffmpeg_options,
+                                         self.thread, engine=self.engine, write_mode=self.write_mode,
+                                         budget=self.budget, retry=self.retry, content_code=video,
+                                         decrypt_pool=self.decrypt_pool, verify_checksum=self.verify_checksum)
+        try:
             if m3u8_downloader.start() and m3u8_downloader.done:
                 self.channel_manager.set_status(str(video), True)
+                self.metrics.inc('videos_total', result='done')
+                self.metrics.observe('video_seconds', time.perf_counter() - start)
             else:
                 self.progress_manager.live.console.print(f'Failed to download video [bold white]{video}[/bold white].',
                                                          style='yellow')
-                continue
-
-            self.progress_manager.overall_update(self.task, advance=1)
+                self.metrics.inc('videos_total', result='failed')
+                return
+        finally:
+            # only active videos keep a row when downloading concurrently
+            if self.parallel > 1:
+                self.progress_manager.remove_task(m3u8_downloader.task)
+
+        self.progress_manager.overall_update(self.task, advance=1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+import time
+import signal
+import threading
+from pathlib import Path
+from urllib.parse import urlparse
+
+from rich.console import Console
+
+from api.api import NCP
+from api.cache import ResponseCache
+from util.decryptor import DecryptPool
+from util.job import JobOptions, run_job
+from util.metrics import Metrics
+from util.progress import ProgressManager
+from util.spool import Spool, Job
+
+
+class Daemon(object):
+    """
+    Run the jobs of a spool one after another until stopped
+
+    One NCP client is kept per site, so the connection pools, rate limiters, response cache and tokens
+    stay warm from one job to the next. Jobs never prompt: tasks are resumed unless the job says otherwise.
+
+    Args:
+        spool (Spool): queue of jobs
+        output (str): output directory of jobs that do not have their own
+        username (str, optional): username for login. Defaults to None.
+        password (str, optional): password for login. Defaults to None.
+        pool_size (int, optional): max number of keep-alive connections per host. Defaults to 10.
+        rate_limits (dict, optional): requests per second of each endpoint class, see NCP. Defaults to None.
+        cache (ResponseCache, optional): cache of API responses shared by every site. Defaults to None.
+        metrics (Metrics, optional): metrics of every job. Defaults to disabled metrics.
+        decrypt_pool (DecryptPool, optional): pool decrypting segments of every job. Defaults to None.
+        poll_interval (float, optional): seconds between two looks at an empty queue. Defaults to 5.
+        exit_when_empty (bool, optional): return once the queue is empty instead of waiting for jobs.
+            Defaults to False.
+        metrics_textfile (Path, optional): Prometheus textfile rewritten after every job. Defaults to None.
+    """
+    def __init__(self, spool: Spool, output: str, username: str = None, password: str = None, pool_size: int = 10,
+                 rate_limits: dict = None, cache: ResponseCache = None, metrics: Metrics = None,
+                 decrypt_pool: DecryptPool = None, poll_interval: float = 5.0, exit_when_empty: bool = False,
+                 metrics_textfile: Path = None) -> None:
+        self.spool = spool
+        self.output = output
+        self.username = username
+        self.password = password
+        self.pool_size = pool_size
+        self.rate_limits = rate_limits
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+        self.decrypt_pool = decrypt_pool
+        self.poll_interval = poll_interval
+        self.exit_when_empty = exit_when_empty
+        self.metrics_textfile = metrics_textfile
+
+        self.clients = {}  # site -> NCP
+        self.console = Console()
+        self.stopped = threading.Event()
+
+    def run(self) -> int:
+        """Run jobs until stopped (SIGINT or SIGTERM), return the number of failed jobs"""
+        # SIGTERM stops the queue like ctrl+c, the running job is put back in the queue and resumed next time
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        # jobs of other live daemons sharing the spool are left alone
+        self.spool.register()
+
+        failed = 0
+        try:
+            recovered = self.spool.recover()
+            if recovered:
+                self.__log(f'{recovered} interrupted jobs put back in the queue')
+
+            while not self.stopped.is_set():
+                job = self.spool.claim()
+                if job is None:
+                    if self.exit_when_empty:
+                        break
+                    self.stopped.wait(self.poll_interval)
+                    continue
+
+                failed += 0 if self.__run(job) else 1
+        except KeyboardInterrupt:
+            self.__log('stopped')
+        finally:
+            for client in self.clients.values():
+                client.transport.close()
+            self.clients.clear()
+            self.spool.unregister()
+
+        return failed
+
+    def stop(self) -> None:
+        """Stop after the running job"""
+        self.stopped.set()
+
+    def client(self, url: str) -> NCP:
+        """Warm NCP client of the site of url"""
+        site = urlparse(url).netloc
+        if site not in self.clients:
+            self.clients[site] = NCP(site, self.username, self.password, self.pool_size, self.rate_limits,
+                                     self.cache, metrics=self.metrics)
+
+        return self.clients[site]
+
+    def __run(self, job: Job) -> bool:
+        """Run a job and move it to done/ or failed/, return True if it succeeded"""
+        self.__log(f'job {job.name} started: {job.url} (priority {job.priority})')
+        start = time.perf_counter()
+
+        try:
+            # nobody is there to answer a prompt
+            options = JobOptions.from_dict(job.options)
+            options.resume = True if options.resume is None else options.resume
+            options.transcode = bool(options.transcode)
+            options.select_manually = False
+            options.check()
+
+            run_job(self.client(job.url), ProgressManager(), job.url, job.output or self.output, options,
+                    self.decrypt_pool)
+        except KeyboardInterrupt:
+            self.spool.requeue(job)
+            raise
+        except Exception as e:
+            self.spool.finish(job, f'{type(e).__name__}: {e}')
+            self.__log(f'job {job.name} failed: {e}', style='red')
+            self.__record('failed', start)
+            return False
+
+        self.spool.finish(job)
+        self.__log(f'job {job.name} done in {time.perf_counter() - start:.1f}s', style='green')
+        self.__record('done', start)
+        return True
+
+    def __record(self, result: str, start: float) -> None:
+        self.metrics.inc('jobs_total', result=result)
+        self.metrics.observe('job_seconds', time.perf_counter() - start)
+        if self.metrics_textfile is not None:
+            self.metrics.write_textfile(self.metrics_textfile)
+
+    def __log(self, message: str, style: str = None) -> None:
+        self.console.print(f'[{time.strftime("%Y-%m-%d %H:%M:%S")}] {message}', style=style, highlight=False,
+                           markup=False)
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
@@ -0,0 +1,142 @@
+import asyncio
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+
+from cryptography.hazmat.primitives.ciphers import Cipher
+from cryptography.hazmat.primitives.ciphers.algorithms import AES
+from cryptography.hazmat.primitives.ciphers.modes import CBC as RFC8216MediaSegmentEncryptMode
+from cryptography.hazmat.backends import default_backend
+
+BLOCK_SIZE = AES.block_size // 8  # bytes
+
+
+@lru_cache(maxsize=16)
+def _algorithm(key: bytes) -> AES:
+    """AES algorithm of a key, validated once and shared by every segment encrypted with it"""
+    return AES(key)
+
+
+def _decryptor(key: bytes, media_sequence: int):
+    """
+    CBC decryption context of a segment
+
+    Update on 2024/09/15, iv should be the media sequence number in big-endian binary
+    representation into a 16-octet (128-bit) buffer and padding (on the left) with zeros.
+    please refer to RFC 8216, Section 5.2:
+    https://datatracker.ietf.org/doc/html/draft-pantos-hls-rfc8216bis#section-5.2
+    """
+    iv = media_sequence.to_bytes(16, 'big')
+    return Cipher(_algorithm(key), RFC8216MediaSegmentEncryptMode(iv), backend=default_backend()).decryptor()
+
+
+def _padding(block: bytes) -> int:
+    """Length of the PKCS7 padding at the end of the last plain block, raise ValueError if it is invalid"""
+    padding = block[-1] if len(block) == BLOCK_SIZE else 0
+    if not 0 < padding <= BLOCK_SIZE or any(byte != padding for byte in block[-padding:]):
+        raise ValueError('Invalid padding bytes.')  # <--- same as the PKCS7 unpadder, the segment is truncated
+
+    return padding
+
+
+class SegmentDecryptor(object):
+    """
+    Incremental AES-128 decryptor of a media segment
+
+    Chunks can be fed as they arrive from the socket, only the last cipher block is held back
+    until finalize() is called, since it carries the padding.
+
+    Chunks are decrypted into a buffer reused from one call to the next (no new bytes object per chunk),
+    so the returned view is only valid until the next call: write or copy it before feeding the next chunk.
+
+    Args:
+        key (bytes): decrypt key
+        media_sequence (int): media sequence number of the segment
+    """
+    def __init__(self, key: bytes, media_sequence: int) -> None:
+        self.decryptor = _decryptor(key, media_sequence)
+        self.buffer = bytearray()
+        self.tail = b''  # last plain block, written by finalize() without its padding
+
+    def update(self, chunk: bytes) -> memoryview:
+        """Decrypt a chunk, return the plain bytes that are safe to write"""
+        # the held back block goes first, then the chunk is decrypted right after it
+        size = len(self.tail) + len(chunk) + BLOCK_SIZE - 1
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)  # <--- a new buffer, the previous one may still be viewed by the caller
+
+        view = memoryview(self.buffer)
+        view[:len(self.tail)] = self.tail
+        end = len(self.tail) + self.decryptor.update_into(chunk, view[len(self.tail):])
+
+        keep = min(end, BLOCK_SIZE)  # <--- CBC only outputs whole blocks
+        self.tail = bytes(view[end - keep:end])
+        return view[:end - keep]
+
+    def finalize(self) -> memoryview:
+        """Flush the remaining plain bytes with padding removed"""
+        tail = self.tail + self.decryptor.finalize()
+        return memoryview(tail)[:len(tail) - _padding(tail)]
+
+
+def decrypt_segment(key: bytes, media_sequence: int, data: bytes) -> bytearray:
+    """
+    Decrypt a whole media segment into a single buffer, padding is trimmed in place
+
+    Args:
+        key (bytes): decrypt key
+        media_sequence (int): media sequence number of the segment
+        data (bytes): encrypted segment
+    """
+    decryptor = _decryptor(key, media_sequence)
+
+    buffer = bytearray(len(data) + BLOCK_SIZE - 1)
+    with memoryview(buffer) as view:
+        end = decryptor.update_into(data, view)
+        decryptor.finalize()  # <--- raise ValueError if the segment is not made of whole blocks (truncated)
+        padding = _padding(bytes(view[max(end - BLOCK_SIZE, 0):end]))
+
+    del buffer[end - padding:]
+    return buffer
+
+
+class DecryptPool(object):
+    """
+    Decryption stage off the download workers
+
+    Segments are downloaded whole and decrypted by the pool, the download workers only wait for the result.
+    'process' runs the decryption in worker processes, so it no longer competes with the network I/O for the GIL
+    (at the price of sending every segment to the worker and back). 'thread' runs it on a dedicated thread pool,
+    so the event loop of the asyncio engine is never blocked by decryption.
+
+    Args:
+        kind (str): 'process' or 'thread'
+        workers (int, optional): number of workers. Defaults to None (number of CPUs).
+    """
+    def __init__(self, kind: str, workers: int = None) -> None:
+        self.kind = kind
+
+        match kind:
+            case 'process':
+                # spawn, forking a process that already runs threads may deadlock the child
+                self.executor: Executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+            case 'thread':
+                self.executor = ThreadPoolExecutor(workers, thread_name_prefix='decrypt')
+            case _:
+                raise ValueError(f'Invalid decrypt pool: {kind}')
+
+    def decrypt(self, key: bytes, media_sequence: int, data: bytes) -> bytearray:
+        """Decrypt a whole segment in the pool, block until it is done"""
+        return self.executor.submit(decrypt_segment, key, media_sequence, data).result()
+
+    async def decrypt_async(self, key: bytes, media_sequence: int, data: bytes) -> bytearray:
+        """Decrypt a whole segment in the pool without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, decrypt_segment, key, media_sequence, data)
+
+    def close(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
@@ -1,4 +1,5 @@
 import subprocess
+import threading
 from typing import Iterator
 import re
 from typing import Optional
@@ -19,6 +20,10 @@ class FFMPEG(object):
         self.total_duration = None
         self.last_line = None
 
+        # used by pipe mode, progress is read by a background thread while segments are written to stdin
+        self.progress = 0.0
+        self.reader = None
+
         self.DUR_REGEX = re.compile(
             r'Duration: (?P<hour>\d{2}):(?P<min>\d{2}):(?P<sec>\d{2})\.(?P<ms>\d{2})'
         )
@@ -74,6 +79,76 @@ class FFMPEG(object):
         else:
             yield None
 
+    def pipe(self, _output: str, vcodec: str, acodec: str, options: list, total_duration: float) -> None:
+        """
+        Start ffmpeg reading MPEG-TS from stdin, feed it with write() and wait for it with finish()
+
+        The duration can not be probed from a pipe, so it must be given (e.g. the sum of the playlist durations).
+        """
+        if options is None:
+            options = []
+
+        self.total_duration = total_duration
+
+        self.cmd = [self.ffmpeg_path,
+                    '-progress', '-', '-nostats', '-y',
+                    '-f', 'mpegts', '-i', 'pipe:0',
+                    '-vcodec', vcodec,
+                    '-acodec', acodec] + options + [_output]
+
+        self.process = subprocess.Popen(
+            self.cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+
+        # keep draining stdout, or ffmpeg blocks on its own output and stops reading stdin
+        self.reader = threading.Thread(target=self.__read_progress, daemon=True)
+        self.reader.start()
+
+    def write(self, data: bytes) -> None:
+        """Write data to ffmpeg stdin (pipe mode)"""
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            self.process.wait()
+            self.reader.join()
+            raise RuntimeError(f'Error while transcoding: {self.last_line}')
+
+    def finish(self) -> Iterator[float]:
+        """Close ffmpeg stdin and yield progress until it exits (pipe mode)"""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        while self.reader.is_alive():
+            self.reader.join(0.1)
+            yield self.progress
+
+        if self.process.wait() != 0:
+            raise RuntimeError(f'Error while transcoding: {self.last_line}')
+        else:
+            yield None
+
+    def abort(self) -> None:
+        """Kill ffmpeg (pipe mode)"""
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def __read_progress(self) -> None:
+        """Read ffmpeg output until it exits, keep the latest progress (pipe mode)"""
+        for line in iter(self.process.stdout.readline, b''):
+            line = line.decode('utf-8', errors='replace').strip()
+            if line != '':
+                self.last_line = line
+
+            progress_time = self.__get_time(line, self.TIME_REGEX)
+            if progress_time and self.total_duration:
+                self.progress = min(progress_time / self.total_duration, 1.0)
+
     def __read_line(self) -> str:
         """Read line from ffmpeg process"""
         line = self.process.stdout.readline()
@@ -0,0 +1,73 @@
+import os
+import errno
+from typing import BinaryIO, Iterator
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024  # bytes copied per call, also the granularity of the progress
+
+# errors meaning the kernel can not copy between these two files, fall back to the next method
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK, errno.EBADF}
+
+# remember unsupported methods, so we don't try them again for every segment
+_methods = {
+    'copy_file_range': hasattr(os, 'copy_file_range'),
+    'sendfile': hasattr(os, 'sendfile'),
+}
+
+
+def copy_into(src: BinaryIO, dst: BinaryIO, size: int, chunk_size: int = COPY_CHUNK_SIZE) -> Iterator[int]:
+    """
+    Append src to dst without pulling the data into python objects, yield number of bytes copied per step
+
+    Try os.copy_file_range first, then os.sendfile, then a plain chunked copy.
+    Both files must be unbuffered (or flushed), since the copy works on file descriptors.
+
+    Args:
+        src (BinaryIO): source file, copied from its current position
+        dst (BinaryIO): destination file, written at its current position
+        size (int): number of bytes to copy
+        chunk_size (int, optional): max bytes per step. Defaults to COPY_CHUNK_SIZE.
+    """
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    remaining = size
+
+    while remaining > 0:
+        copied = _copy_chunk(src_fd, dst_fd, min(chunk_size, remaining))
+        if copied == 0:
+            break  # source is shorter than expected
+
+        remaining -= copied
+        yield copied
+
+
+def _copy_chunk(src_fd: int, dst_fd: int, count: int) -> int:
+    """Copy up to count bytes between the current positions of both files"""
+    if _methods['copy_file_range']:
+        try:
+            return os.copy_file_range(src_fd, dst_fd, count)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            _methods['copy_file_range'] = False
+
+    if _methods['sendfile']:
+        offset = os.lseek(src_fd, 0, os.SEEK_CUR)
+        try:
+            copied = os.sendfile(dst_fd, src_fd, offset, count)
+            os.lseek(src_fd, offset + copied, os.SEEK_SET)  # sendfile with offset does not move the source
+            return copied
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            _methods['sendfile'] = False
+
+    data = os.read(src_fd, count)
+    view = memoryview(data)
+    written = 0
+    while written < len(data):
+        written += os.write(dst_fd, view[written:])
+
+    return len(data)
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
@@ -0,0 +1,169 @@
+from pathlib import Path
+from urllib.parse import urlparse, urlunparse
+
+from api.api import NCP, ContentCode
+from util.channel_downloader import ChannelDownloader
+from util.decryptor import DecryptPool
+from util.ffmpeg import FFMPEG
+from util.m3u8_downloader import M3U8Downloader
+from util.options import Engine, WriteMode, parse_resolution
+from util.progress import ProgressManager
+from util.retry import RetryPolicy
+
+
+class JobOptions(object):
+    """
+    Download options of a job, shared by the command line and the queue mode
+
+    Args:
+        resolution (tuple, optional): target resolution of video. Defaults to None (highest).
+        resume (bool, optional): resume download. Defaults to None (ask).
+        transcode (bool, optional): transcode video. Defaults to False.
+        ffmpeg (str, optional): ffmpeg path. Defaults to 'ffmpeg'.
+        vcodec (str, optional): video codec. Defaults to 'copy'.
+        acodec (str, optional): audio codec. Defaults to 'copy'.
+        ffmpeg_options (list, optional): ffmpeg options. Defaults to None.
+        thread (int, optional): number of threads. Defaults to 1.
+        engine (str, optional): segment download engine, 'thread' or 'asyncio'. Defaults to 'thread'.
+        write_mode (str, optional): 'temp', 'direct' or 'pipe', see M3U8Downloader. Defaults to 'temp'.
+        parallel (int, optional): number of videos of a channel downloaded at once. Defaults to 1.
+        retries (int, optional): max attempts per segment in a round. Defaults to 5.
+        select_manually (bool, optional): manually select videos of a channel. Defaults to False.
+        verify_checksum (bool, optional): compare checksums of resumed segments. Defaults to False.
+        incremental (bool, optional): only list the videos of a channel newer than the last sync. Defaults to False.
+        full_sync_interval (float, optional): hours between two full listings of an incremental sync. Defaults to 24.
+    """
+    def __init__(self, resolution: tuple = None, resume: bool = None, transcode: bool = False,
+                 ffmpeg: str = 'ffmpeg', vcodec: str = 'copy', acodec: str = 'copy', ffmpeg_options: list = None,
+                 thread: int = 1, engine: str = 'thread', write_mode: str = 'temp', parallel: int = 1,
+                 retries: int = 5, select_manually: bool = False, verify_checksum: bool = False,
+                 incremental: bool = False, full_sync_interval: float = 24) -> None:
+        self.resolution = resolution
+        self.resume = resume
+        self.transcode = transcode
+        self.ffmpeg = ffmpeg
+        self.vcodec = vcodec
+        self.acodec = acodec
+        self.ffmpeg_options = ffmpeg_options
+        self.thread = thread
+        self.engine = engine
+        self.write_mode = write_mode
+        self.parallel = parallel
+        self.retries = retries
+        self.select_manually = select_manually
+        self.verify_checksum = verify_checksum
+        self.incremental = incremental
+        self.full_sync_interval = full_sync_interval
+
+    @classmethod
+    def from_dict(cls, options: dict) -> 'JobOptions':
+        """
+        Options of a queued job, named like the command line options (e.g. {"thread": 2, "write_mode": "direct"})
+
+        resolution is given as '1920x1080' and ffmpeg_options as a single string, like on the command line.
+        Raise ValueError on unknown options and on values the command line would refuse, so a job that can only
+        fail is refused when it is queued.
+        """
+        options = dict(options)
+
+        unknown = set(options) - set(vars(cls()))
+        if unknown:
+            raise ValueError(f'Unknown job options: {", ".join(sorted(unknown))}.')
+
+        if options.get('resolution') is not None:
+            options['resolution'] = parse_resolution(str(options['resolution']))
+        if isinstance(options.get('ffmpeg_options'), str):
+            options['ffmpeg_options'] = options['ffmpeg_options'].split(' ')
+
+        for name, choices in (('engine', Engine), ('write_mode', WriteMode)):
+            if name in options and options[name] not in {choice.value for choice in choices}:
+                raise ValueError(f'Invalid {name}: {options[name]} (choose from '
+                                 f'{", ".join(choice.value for choice in choices)}).')
+
+        for name in ('thread', 'parallel', 'retries'):
+            if name in options and (type(options[name]) is not int or options[name] < 1):
+                raise ValueError(f'Invalid {name}: {options[name]} (a positive integer).')
+
+        if 'full_sync_interval' in options and (not isinstance(options['full_sync_interval'], (int, float))
+                                                or options['full_sync_interval'] < 0):
+            raise ValueError(f'Invalid full_sync_interval: {options["full_sync_interval"]} (hours).')
+
+        return cls(**options)
+
+    def check(self) -> None:
+        """Check that everything the job needs is there before it starts"""
+        if (self.transcode or self.write_mode == 'pipe') and not FFMPEG(self.ffmpeg).check():
+            raise FileNotFoundError('ffmpeg not found.')
+
+
+def run_job(api_client: NCP, progress_manager: ProgressManager, query: str, output: str, options: JobOptions,
+            decrypt_pool: DecryptPool = None) -> None:
+    """
+    Download a video, or every video of a channel, raise an exception if it fails
+
+    Args:
+        api_client (NCP): NCP object of the site of the query
+        progress_manager (ProgressManager): progress manager, entered while downloading
+        query (str): URL of the video or channel
+        output (str): output directory
+        options (JobOptions): download options
+        decrypt_pool (DecryptPool, optional): pool decrypting segments, see M3U8Downloader. Defaults to None.
+    """
+    # Check if query is channel or video
+    channel_id = api_client.get_channel_id(query)
+    if channel_id is None:
+        # Get video information
+        channel_query = urlparse(query).path.strip('/').split('/')[0]
+        channel_query = str(urlunparse(urlparse(query)._replace(path=f'/{channel_query}')))
+        channel_id = api_client.get_channel_id(channel_query)
+        channel_name = api_client.get_channel_info(channel_id)['fanclub_site_name']
+
+        # Get video session id
+        query = urlparse(query).path.strip('/').split('/')[-1]
+        session_id = api_client.get_session_id(ContentCode(query))
+
+        # Check if video exists
+        if session_id is None:
+            raise ValueError('Video not found or permission denied.')
+
+        output_name, _ = api_client.get_video_name(ContentCode(query))
+
+        output = str(Path(output).joinpath(channel_name).joinpath(output_name))
+
+        with progress_manager:
+            m3u8_downloader = M3U8Downloader(api_client, progress_manager, session_id, output, options.resolution,
+                                             options.resume, options.transcode, options.ffmpeg, options.vcodec,
+                                             options.acodec, options.ffmpeg_options, options.thread,
+                                             engine=options.engine, write_mode=options.write_mode,
+                                             retry=RetryPolicy(options.retries), content_code=ContentCode(query),
+                                             decrypt_pool=decrypt_pool, verify_checksum=options.verify_checksum)
+            if not m3u8_downloader.start():
+                raise RuntimeError('Failed to download video.')
+    else:
+        # Get channel infomation
+        channel_name = api_client.get_channel_info(channel_id)['fanclub_site_name']
+
+        # Get video list, keep the video pages so titles and dates need no extra request
+        # an incremental sync is listed by the channel manager, from the newest video it knows of
+        if options.incremental:
+            video_list = None
+        else:
+            video_list = [ContentCode(video['content_code'], video) for video in api_client.iter_videos(channel_id)]
+
+        output = str(Path(output).joinpath(channel_name))
+
+        with progress_manager:
+            channel_downloader = ChannelDownloader(api_client, progress_manager, channel_id, video_list, output,
+                                                   options.resolution, options.resume, options.transcode,
+                                                   options.ffmpeg, options.vcodec, options.acodec,
+                                                   options.ffmpeg_options, options.thread, options.select_manually,
+                                                   engine=options.engine, write_mode=options.write_mode,
+                                                   parallel=options.parallel, retry=RetryPolicy(options.retries),
+                                                   decrypt_pool=decrypt_pool, verify_checksum=options.verify_checksum,
+                                                   incremental=options.incremental,
+                                                   full_sync_interval=options.full_sync_interval * 3600)
+            channel_downloader.start()
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
@@ -1,19 +1,105 @@
-import requests
-import m3u8
-from cryptography.hazmat.primitives.ciphers import Cipher
-from cryptography.hazmat.primitives.ciphers.algorithms import AES
-from cryptography.hazmat.primitives.ciphers.modes import CBC as RFC8216MediaSegmentEncryptMode
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.padding import PKCS7
+import os
 import time
+import zlib
+import m3u8
+import asyncio
 import inquirer
 from pathlib import Path
+from requests import RequestException
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import AsyncIterator, Iterable, Iterator, NamedTuple, Optional, Tuple
 
-from api.api import NCP, SessionID
+from api.api import NCP, SessionID, ContentCode
+from util.budget import ConcurrencyBudget
+from util.decryptor import SegmentDecryptor, DecryptPool, decrypt_segment
 from util.ffmpeg import FFMPEG
+from util.fileio import copy_into
 from util.manager import M3U8Manager
+from util.metrics import Metrics
 from util.progress import ProgressManager
+from util.retry import RetryPolicy, SESSION_EXPIRED_STATUS
+from util.writer import OrderedWriter
+
+CHUNK_SIZE = 64 * 1024  # size of each chunk streamed from the socket to the decryptor
+
+
+class SegmentInfo(NamedTuple):
+    """Precomputed descriptor of a video segment"""
+    index: int
+    media_sequence: int
+    uri: str
+    key: bytes
+
+
+class SegmentSink(object):
+    """
+    Chunks of a segment being downloaded, the same steps for both engines
+
+    A segment saved to its temp file is decrypted and written chunk by chunk, a segment for the writer or the
+    decrypt pool is collected into a single buffer (sized by Content-Length when the server sends it) and
+    decrypted as a whole once every chunk is in, so it is never copied on the way.
+
+    Args:
+        segment (SegmentInfo): segment
+        path (str, optional): temp file of the segment. Defaults to None (collect the segment).
+        metrics (Metrics, optional): metrics of the decrypt and write stages. Defaults to disabled metrics.
+        size (int, optional): expected size of the segment (Content-Length). Defaults to None (unknown).
+    """
+    def __init__(self, segment: SegmentInfo, path: str = None, metrics: Metrics = None, size: int = None) -> None:
+        metrics = metrics if metrics is not None else Metrics(enabled=False)
+
+        self.segment = segment
+        self.decrypt = metrics.stopwatch('stage_seconds', stage='decrypt')
+        self.write = metrics.stopwatch('stage_seconds', stage='write')
+        self.crc = 0
+
+        # encrypted segment if it is collected, None if it is saved chunk by chunk
+        self.collected = (bytearray(size) if size else bytearray()) if path is None else None
+        self.received = 0
+        self.decryptor = SegmentDecryptor(segment.key, segment.media_sequence) if path is not None else None
+        self.file = open(path, 'wb') if path is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.file is not None:
+            self.file.close()
+
+    def update(self, chunk: bytes) -> None:
+        """Take the next chunk of the segment"""
+        if self.collected is not None:
+            # grows the buffer if the server sends more than announced
+            self.collected[self.received:self.received + len(chunk)] = chunk
+            self.received += len(chunk)
+            return
+
+        with self.decrypt:
+            data = self.decryptor.update(chunk)
+        self.__write(data)
+
+    def end(self) -> None:
+        """Every chunk is in, trim a collected segment to what was received (a truncated one fails to decrypt)"""
+        if self.collected is not None:
+            del self.collected[self.received:]
+
+    def finish(self) -> Tuple[int, int]:
+        """Write the last block and close the temp file, return size and crc32 of the segment"""
+        with self.decrypt:
+            data = self.decryptor.finalize()
+        self.__write(data)
+
+        size = self.file.tell()
+        self.file.close()
+
+        self.decrypt.record()
+        self.write.record()
+        return size, self.crc
+
+    def __write(self, data: bytes) -> None:
+        with self.write:
+            self.file.write(data)
+            self.crc = zlib.crc32(data, self.crc)
 
 
 class M3U8Downloader(object):
@@ -32,13 +118,28 @@ class M3U8Downloader(object):
         vcodec (str, optional): video codec. Defaults to 'copy'.
         acodec (str, optional): audio codec. Defaults to 'copy'.
         ffmpeg_options (list, optional): ffmpeg options. Defaults to None.
-        thread (int, optional): number of threads. Defaults to 1.
-        wait (float, optional): wait time between each request(exclude download). Defaults to 1.
+        thread (int, optional): number of threads, or in-flight requests for the asyncio engine. Defaults to 1.
+        engine (str, optional): segment download engine, 'thread' or 'asyncio'. Defaults to 'thread'.
+        write_mode (str, optional): 'temp' to keep one temp file per segment and concatenate them at the end,
+            'direct' to write segments straight into the output file in order,
+            'pipe' to feed segments in order into ffmpeg while downloading (implies transcode). Defaults to 'temp'.
+        budget (ConcurrencyBudget, optional): in-flight segment requests shared with other downloaders.
+            Defaults to a budget of `thread` requests for this video alone.
+        retry (RetryPolicy, optional): retry policy of segments. Defaults to RetryPolicy().
+        content_code (ContentCode, optional): content code of video, used to get a new session id when
+            the session expires. Defaults to None (reload the playlist with the same session id).
+        decrypt_pool (DecryptPool, optional): pool decrypting whole segments off the download workers.
+            Defaults to None (decrypt on the download workers).
+        verify_checksum (bool, optional): on resume, compare the checksum of every segment already downloaded
+            on top of the size and MPEG-TS sync byte checks. Defaults to False.
     """
     def __init__(self, api_client: NCP, progress_manager: ProgressManager, session_id: SessionID, output: str,
                  targer_resolution: tuple = None, resume: bool = None, transcode: bool = None,
                  ffmpeg: str = 'ffmpeg', vcodec: str = 'copy', acodec: str = 'copy', ffmpeg_options: list = None,
-                 thread: int = 1, wait: float = 1) -> None:
+                 thread: int = 1, engine: str = 'thread', write_mode: str = 'temp',
+                 budget: ConcurrencyBudget = None, retry: RetryPolicy = None,
+                 content_code: ContentCode = None, decrypt_pool: DecryptPool = None,
+                 verify_checksum: bool = False) -> None:
         # args
         self.api_client = api_client
         self.progress_manager = progress_manager
@@ -52,7 +153,20 @@ class M3U8Downloader(object):
         self.acodec = acodec
         self.ffmpeg_options = ffmpeg_options
         self.thread = thread
-        self.wait = wait
+        self.engine = engine
+        self.write_mode = write_mode
+        self.budget = budget if budget is not None else ConcurrencyBudget(self.thread)
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.content_code = content_code
+        self.decrypt_pool = decrypt_pool
+        self.verify_checksum = verify_checksum
+        self.metrics = self.api_client.transport.metrics
+
+        # pipe mode always transcodes, there is no .ts file left to keep
+        # and a half transcoded output can not be continued, so there is no task to resume either
+        if self.write_mode == 'pipe':
+            self.transcode = True
+            self.resume = False
 
         # init manager
         self.m3u8_manager = M3U8Manager(f'{self.output}.ts', resume=self.resume)
@@ -60,13 +174,17 @@ class M3U8Downloader(object):
         # data load from session
         self.video_index = None
         self.target_video = None
+        self.segments = None  # list of SegmentInfo, in playlist order
+        self.session_expired = False  # set by workers when segments are refused because of the session
 
         # decrypt settings
-        self.algorithm = AES  # Decrypt algorithm
-        self.mode = RFC8216MediaSegmentEncryptMode  # Decrypt mode
-        self.unpadder = PKCS7(128)
         self.key = None  # Decrypt key
 
+        # ordered writer of the output file (direct write mode) or ffmpeg stdin (pipe write mode)
+        self.writer = None
+        self.transcoder = None  # ffmpeg fed by the writer in pipe write mode
+        self.checksums = {}  # index -> crc32 of segments waiting in the writer
+
         # init task progress
         self.task = self.progress_manager.add_task('Start downloading', total=None)
 
@@ -74,23 +192,56 @@ class M3U8Downloader(object):
 
     def start(self) -> bool:
         """Start downloading video"""
-
-        # loop until all segments are downloaded
-        while True:
-            # check if video is available and get video index
-            if not self.__get_video_index():
+        try:
+            # rounds over the missing segments, the playlist is only reloaded when the session has expired
+            for _ in range(self.retry.rounds):
+                if self.target_video is None or self.session_expired:
+                    if not self.__load_playlist():
+                        self.progress_manager.stop_task(self.task)
+                        self.__abort_transcoder()
+                        return False
+
+                # until all segments are downloaded, break
+                if self.__download_segments():
+                    break
+            else:
                 self.progress_manager.stop_task(self.task)
+                self.__abort_transcoder()
                 return False
+        except BaseException:
+            self.__abort_transcoder()
+            raise
 
-            # workflow
-            self.__get_target_video()
-            self.__get_key()
-            self.__init_manager()
-            # until all segments are downloaded, break
-            if self.__download_threading():
-                break
+        if self.write_mode == 'temp':
+            self.__concat_temp()
+
+        self.__post_process()
+
+        return True
 
-        self.__concat_temp()
+    def __load_playlist(self) -> bool:
+        """Load playlist and key of the video, with a new session id if the old one has expired"""
+        if self.session_expired:
+            if self.content_code is not None:
+                session_id = self.api_client.get_session_id(self.content_code)
+                if session_id is None:
+                    return False
+                self.session_id = session_id
+            self.session_expired = False
+
+        # check if video is available and get video index
+        if not self.__get_video_index():
+            return False
+
+        # workflow
+        self.__get_target_video()
+        self.__get_key()
+        self.__init_segments()
+        self.__init_manager()
+
+        # a reloaded playlist that does not match the journal starts it over, ffmpeg has to start over with it
+        if self.transcoder is not None and not self.m3u8_manager.continued:
+            self.__abort_transcoder()
 
         return True
 
@@ -100,14 +251,15 @@ class M3U8Downloader(object):
         self.progress_manager.reset(self.task, description='Getting video index')
 
         # get video index from session
-        r = requests.get(self.api_client.api_video_index % self.session_id)
+        with self.metrics.time('stage_seconds', stage='playlist'):
+            r = self.api_client.transport.get(self.api_client.api_video_index % self.session_id, endpoint='hls',
+                                              name='video_index')
         if 'Error' in r.text:
+            self.api_client.transport.limiter.penalize('hls')  # back off, the server may be refusing us
             return False
 
         self.video_index = m3u8.loads(r.text)
 
-        time.sleep(self.wait)  # don't spam the server
-
         return True  # this is for checking if the video is available now
 
     def __get_target_video(self) -> None:
@@ -123,41 +275,24 @@ class M3U8Downloader(object):
                     break
 
         # get target video from video index
-        r = requests.get(target_video)
+        with self.metrics.time('stage_seconds', stage='playlist'):
+            r = self.api_client.transport.get(target_video, endpoint='hls', name='playlist')
 
         self.target_video = m3u8.loads(r.text)
 
-        time.sleep(self.wait)  # don't spam the server
-
     def __get_key(self) -> None:
         """Get key from target video"""
         # update progress bar
         self.progress_manager.reset(self.task, description='Getting key')
 
-        r = requests.get(self.target_video.keys[0].absolute_uri)
+        with self.metrics.time('stage_seconds', stage='key'):
+            r = self.api_client.transport.get(self.target_video.keys[0].absolute_uri, endpoint='hls', name='key')
         self.key = r.content
 
-        time.sleep(self.wait)  # don't spam the server
-
-    def __decrypt(self, content: bytes, media_sequence):
-        """
-        Decrypt video segment
-
-        Update on 2024/09/15, iv should be the media sequence number in big-endian binary
-        representation into a 16-octet (128-bit) buffer and padding (on the left) with zeros.
-        please refer to RFC 8216, Section 5.2:
-        https://datatracker.ietf.org/doc/html/draft-pantos-hls-rfc8216bis#section-5.2
-        """
-        iv = media_sequence.to_bytes(16, 'big')
-        cipher = Cipher(self.algorithm(self.key), self.mode(iv), backend=default_backend())
-
-        decryptor = cipher.decryptor()
-        decrypted = decryptor.update(content) + decryptor.finalize()
-
-        unpadder = self.unpadder.unpadder()
-        unpadded = unpadder.update(decrypted) + unpadder.finalize()
-
-        return unpadded
+    def __init_segments(self) -> None:
+        """Build segment descriptors, so workers never have to look up the playlist"""
+        self.segments = [SegmentInfo(index, segment.media_sequence, segment.absolute_uri, self.key)
+                         for index, segment in enumerate(self.target_video.segments)]
 
     def __init_manager(self) -> None:
         """Initialize M3U8Manager"""
@@ -169,9 +304,93 @@ class M3U8Downloader(object):
         else:
             percentage = self.m3u8_manager.init_manager(self.target_video.segments)
 
+        # the temp files of a resumed task may have been truncated by a crash or a full disk
+        # the output file of direct write mode is checked when it is opened
+        if self.write_mode == 'temp' and self.m3u8_manager.completed > 0:
+            self.progress_manager.update(self.task, description='Verifying segments')
+            with self.metrics.time('stage_seconds', stage='verify'):
+                failed = self.m3u8_manager.verify_segments(self.verify_checksum)
+            if failed:
+                self.progress_manager.live.console.print(
+                    f'{failed} downloaded segments are damaged, downloading them again.', style='yellow')
+            percentage = self.m3u8_manager.completed / len(self.segments)
+
         # update progress bar
         self.progress_manager.reset(self.task, total=1, completed=percentage)
 
+    def __download_segments(self) -> bool:
+        """Download video segments with the selected engine"""
+        match self.write_mode:
+            case 'temp':
+                pass
+            case 'direct':
+                self.writer = self.__open_writer()
+            case 'pipe':
+                self.writer = self.__open_pipe()
+            case _:
+                raise ValueError(f'Invalid write mode: {self.write_mode}')
+
+        try:
+            match self.engine:
+                case 'thread':
+                    return self.__download_threading()
+                case 'asyncio':
+                    return self.__download_asyncio()
+                case _:
+                    raise ValueError(f'Invalid download engine: {self.engine}')
+        finally:
+            # ffmpeg stays open across rounds, it is closed in __post_process
+            if self.write_mode == 'direct':
+                self.writer.file.close()
+            self.writer = None
+
+    def __open_writer(self) -> OrderedWriter:
+        """Open the output file for direct writing, continue after the segments already written"""
+        output = Path(f'{self.output}.ts')
+
+        # the output file is only valid up to the first missing segment
+        count, offset = self.m3u8_manager.keep_prefix()
+        if not output.exists() or output.stat().st_size < offset or 0 in self.m3u8_manager.segment_size[:count]:
+            count, offset = self.m3u8_manager.keep_prefix(0)  # the file does not match the journal, start over
+        elif count > 0:
+            with self.metrics.time('stage_seconds', stage='verify'):
+                count, offset = self.m3u8_manager.verify_prefix(output, count, self.verify_checksum)
+
+        # unbuffered, so a segment is in the file before it is marked as done
+        f = open(output, 'r+b' if output.exists() else 'wb', buffering=0)
+        f.truncate(offset)
+        f.seek(offset)
+
+        self.progress_manager.update(self.task, completed=count / len(self.segments))
+
+        return OrderedWriter(f, count, max(self.thread * 2, 2), self.__complete_written)
+
+    def __pending_segments(self) -> list:
+        """Get segments that are not downloaded yet"""
+        return [segment for segment in self.segments if not self.m3u8_manager.get_status(segment.index)]
+
+    def __open_pipe(self) -> OrderedWriter:
+        """Start ffmpeg on the first round, continue feeding it after the segments already piped"""
+        if self.transcoder is None:
+            # a half transcoded output can not be continued, always start from the first segment
+            count, _ = self.m3u8_manager.keep_prefix(0)
+
+            self.transcoder = FFMPEG(self.ffmpeg)
+            self.transcoder.pipe(f'{self.output}.mp4', self.vcodec, self.acodec, self.ffmpeg_options,
+                                 sum(segment.duration for segment in self.target_video.segments))
+        else:
+            count, _ = self.m3u8_manager.keep_prefix()
+
+        self.progress_manager.update(self.task, completed=count / len(self.segments))
+
+        return OrderedWriter(self.transcoder, count, max(self.thread * 2, 2), self.__complete_written)
+
+    def __abort_transcoder(self) -> None:
+        """Kill ffmpeg of pipe write mode (if any)"""
+        if self.transcoder is not None:
+            self.transcoder.abort()
+            self.transcoder = None
+
     def __download_threading(self) -> bool:
         """Download video segments with threading"""
         # because we already reset the progress bar in __init_manager, we don't need to reset it again
@@ -180,7 +399,7 @@ class M3U8Downloader(object):
 
         # download video segments
         with ThreadPoolExecutor(max_workers=self.thread) as executor:
-            futures = [executor.submit(self.__download_thread, segment) for segment in self.target_video.segments]
+            futures = [executor.submit(self.__download_thread, segment) for segment in self.__pending_segments()]
 
             try:
                 for future in as_completed(futures):
@@ -191,50 +410,278 @@ class M3U8Downloader(object):
                 executor.shutdown(wait=False, cancel_futures=True)
                 raise KeyboardInterrupt
 
-        if not all(self.m3u8_manager.segment_db):
+        return self.m3u8_manager.is_done()
+
+    def __download_thread(self, segment: SegmentInfo) -> bool:
+        """Download video segment, retry it on its own with backoff"""
+        # wait for a slot in the reorder buffer
+        if self.writer is not None and not self.writer.reserve(segment.index):
             return False
 
-        return True
+        try:
+            for attempt in range(self.retry.attempts):
+                if self.session_expired:
+                    break  # no use retrying until the playlist is reloaded
+                time.sleep(self.retry.delay(attempt))
+
+                # only the transfer is timed, not the wait for a slot nor the decrypt and write of the chunks
+                transfer = self.metrics.stopwatch('stage_seconds', stage='segment')
+                try:
+                    # stream the segment to the temp file (or the writer)
+                    with self.budget:
+                        with transfer:
+                            r = self.api_client.transport.get(segment.uri, endpoint='segment', stream=True,
+                                                              headers=self.api_client.headers)
+                        with r:
+                            if r.status_code == 200:
+                                self.__save_segment(segment, self.__timed(r.iter_content(CHUNK_SIZE), transfer),
+                                                    self.__content_length(r.headers.get('Content-Length')))
+                                self.metrics.inc('segment_attempts_total', result='ok')
+                                return True
+                            if r.status_code in SESSION_EXPIRED_STATUS:
+                                self.session_expired = True
+                            self.metrics.inc('segment_attempts_total', result='http_error')
+                except (RequestException, ValueError):
+                    self.metrics.inc('segment_attempts_total', result='error')
+                    continue  # connection dropped or the segment was truncated (bad padding)
+                finally:
+                    transfer.record()
+        except BaseException:
+            self.__abort_writer()
+            raise
+
+        # the segment failed to download, it will be retried in the next round
+        self.__abort_writer()
+        return False
 
-    def __download_thread(self, segment: m3u8.Segment) -> bool:
-        """Download video segment"""
-        # if the segment is already downloaded, skip
-        if self.m3u8_manager.get_status(self.target_video.segments.index(segment)):
-            # update progress bar
-            self.progress_manager.update(self.task,
-                                         completed=sum(self.m3u8_manager.segment_db) / len(self.target_video.segments))
-            return True
+    def __abort_writer(self) -> None:
+        """The output file can not pass a missing segment, stop this round and retry from the gap"""
+        if self.writer is not None:
+            self.writer.abort()
+
+    def __download_asyncio(self) -> bool:
+        """Download video segments on a single asyncio event loop"""
+        # because we already reset the progress bar in __init_manager, we don't need to reset it again
+        # just update the description
+        self.progress_manager.update(self.task, description='Downloading video')
 
-        # or, download the segment
-        r = requests.get(segment.absolute_uri, headers=self.api_client.headers)
-        if r.status_code == 200:
-            with open(f'{self.m3u8_manager.temp}/{self.target_video.segments.index(segment)}.ts', 'wb') as f:
-                f.write(self.__decrypt(r.content, segment.media_sequence))
+        try:
+            asyncio.run(self.__download_asyncio_main())
+        except KeyboardInterrupt:
+            self.progress_manager.live.console.print(
+                'got your interrupt request, hold on... do not press ctrl+c again', style='bold red on white')
+            raise KeyboardInterrupt
+
+        return self.m3u8_manager.is_done()
+
+    async def __download_asyncio_main(self) -> None:
+        """Run a bounded number of segment workers sharing one connection pool"""
+        import aiohttp  # only needed by the asyncio engine
+
+        queue = asyncio.Queue()
+        for segment in self.__pending_segments():
+            queue.put_nowait(segment)
+
+        connector = aiohttp.TCPConnector(limit=self.thread, limit_per_host=self.thread)
+        async with aiohttp.ClientSession(headers=self.api_client.headers,
+                                         connector=connector) as session:
+            # each worker keeps one request in flight, so self.thread bounds the concurrency
+            workers = [asyncio.create_task(self.__download_asyncio_worker(session, queue))
+                       for _ in range(min(self.thread, queue.qsize()))]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
 
-                # set the segment as downloaded
-                self.m3u8_manager.set_status(self.target_video.segments.index(segment), True)
+    async def __download_asyncio_worker(self, session, queue: asyncio.Queue) -> None:
+        """Download video segments from the queue until it is empty"""
+        while not queue.empty():
+            segment = queue.get_nowait()
 
-                # update progress bar
-                self.progress_manager.update(self.task, completed=sum(self.m3u8_manager.segment_db) / len(
-                    self.target_video.segments))
-                return True
+            # wait for a slot in the reorder buffer
+            if self.writer is not None and not await self.writer.reserve_async(segment.index):
+                return
+
+            try:
+                if not await self.__download_asyncio_segment(session, segment):
+                    # the segment failed to download, it will be retried in the next round
+                    self.__abort_writer()
+            except BaseException:
+                self.__abort_writer()
+                raise
+
+    async def __download_asyncio_segment(self, session, segment: SegmentInfo) -> bool:
+        """Download video segment, retry it on its own with backoff"""
+        import aiohttp  # only needed by the asyncio engine
+
+        for attempt in range(self.retry.attempts):
+            if self.session_expired:
+                break  # no use retrying until the playlist is reloaded
+            await asyncio.sleep(self.retry.delay(attempt))
+
+            # only the transfer is timed, not the wait for a slot nor the decrypt and write of the chunks
+            transfer = self.metrics.stopwatch('stage_seconds', stage='segment')
+            try:
+                await self.api_client.transport.limiter.acquire_async('segment')
+                async with self.budget:
+                    with transfer:
+                        r = await session.get(segment.uri)
+                    async with r:
+                        self.api_client.transport.limiter.feedback('segment', r.status, r.headers.get('Retry-After'))
+                        self.metrics.observe('http_request_seconds', transfer.elapsed, endpoint='segment',
+                                             endpoint_class='segment')
+                        self.metrics.inc('http_responses_total', endpoint='segment', endpoint_class='segment',
+                                         status=r.status)
+                        if r.status == 200:
+                            await self.__save_segment_asyncio(segment,
+                                                              self.__timed_async(r.content.iter_chunked(CHUNK_SIZE),
+                                                                                 transfer),
+                                                              r.content_length)
+                            self.metrics.inc('segment_attempts_total', result='ok')
+                            return True
+                        if r.status in SESSION_EXPIRED_STATUS:
+                            self.session_expired = True
+                        self.metrics.inc('segment_attempts_total', result='http_error')
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                self.metrics.inc('segment_attempts_total', result='error')
+                continue  # connection dropped or the segment was truncated (bad padding)
+            finally:
+                transfer.record()
 
-        # the segment failed to download(status code not 200)
         return False
 
+    @staticmethod
+    def __timed(chunks: Iterable[bytes], stopwatch) -> Iterator[bytes]:
+        """Yield chunks, timing only the wait for each of them"""
+        chunks = iter(chunks)
+        while True:
+            with stopwatch:
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    @staticmethod
+    async def __timed_async(chunks: AsyncIterator[bytes], stopwatch) -> AsyncIterator[bytes]:
+        """Yield chunks, timing only the wait for each of them"""
+        chunks = aiter(chunks)
+        while True:
+            with stopwatch:
+                chunk = await anext(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def __segment_path(self, segment: SegmentInfo) -> str:
+        """Get temp file path of video segment"""
+        return str(self.m3u8_manager.segment_path(segment.index))
+
+    @staticmethod
+    def __content_length(value: Optional[str]) -> Optional[int]:
+        """Size announced by the server, None if it did not announce one"""
+        return int(value) if value is not None and value.isdigit() else None
+
+    def __save_segment(self, segment: SegmentInfo, chunks: Iterable[bytes], size: int = None) -> None:
+        """Decrypt video segment chunk by chunk and save it to temp folder (or pass it to the writer)"""
+        with self.__open_sink(segment, size) as sink:
+            for chunk in chunks:
+                sink.update(chunk)
+            sink.end()
+
+            decrypted = None
+            if self.decrypt_pool is not None:
+                with sink.decrypt:
+                    decrypted = self.decrypt_pool.decrypt(segment.key, segment.media_sequence, sink.collected)
+
+            self.__finish_segment(sink, decrypted)
+
+    async def __save_segment_asyncio(self, segment: SegmentInfo, chunks: AsyncIterator[bytes],
+                                     size: int = None) -> None:
+        """Decrypt video segment chunk by chunk and save it to temp folder (or pass it to the writer)"""
+        with self.__open_sink(segment, size) as sink:
+            async for chunk in chunks:
+                sink.update(chunk)
+            sink.end()
+
+            decrypted = None
+            if self.decrypt_pool is not None:
+                with sink.decrypt:
+                    decrypted = await self.decrypt_pool.decrypt_async(segment.key, segment.media_sequence,
+                                                                      sink.collected)
+
+            self.__finish_segment(sink, decrypted)
+
+    def __open_sink(self, segment: SegmentInfo, size: int = None) -> SegmentSink:
+        """Sink of the chunks of video segment, size is its Content-Length if the server sent one"""
+        # the writer and the decrypt pool take the segment as a whole
+        if self.writer is not None or self.decrypt_pool is not None:
+            return SegmentSink(segment, metrics=self.metrics, size=size)
+
+        return SegmentSink(segment, self.__segment_path(segment), self.metrics)
+
+    def __finish_segment(self, sink: SegmentSink, decrypted: Optional[bytes] = None) -> None:
+        """Save video segment once every chunk is in, decrypted is the segment if the decrypt pool decrypted it"""
+        if sink.collected is None:
+            size, crc = sink.finish()
+            return self.__complete_segment(sink.segment, size, crc)
+
+        if decrypted is None:
+            with sink.decrypt:
+                decrypted = decrypt_segment(sink.segment.key, sink.segment.media_sequence, sink.collected)
+        sink.decrypt.record()
+
+        self.__write_segment(sink.segment, decrypted)
+
+    def __write_segment(self, segment: SegmentInfo, data: bytes) -> None:
+        """Save decrypted video segment to temp folder (or pass it to the writer)"""
+        with self.metrics.time('stage_seconds', stage='write'):
+            crc = zlib.crc32(data)
+
+            # the writer marks the segment as done once it is written to the output file
+            if self.writer is not None:
+                self.checksums[segment.index] = crc
+                return self.writer.write(segment.index, data)
+
+            with open(self.__segment_path(segment), 'wb') as f:
+                f.write(data)
+
+        self.__complete_segment(segment, len(data), crc)
+
+    def __complete_written(self, index: int, size: int) -> None:
+        """Mark video segment written by the writer as downloaded"""
+        self.__complete_segment(self.segments[index], size, self.checksums.pop(index, None))
+
+    def __complete_segment(self, segment: SegmentInfo, size: int, crc: int = None) -> None:
+        """Mark video segment as downloaded"""
+        # set the segment as downloaded
+        self.m3u8_manager.set_status(segment.index, True, size, crc)
+        self.metrics.inc('segment_bytes_total', size)
+
+        # update progress bar
+        self.progress_manager.advance_bytes(self.task, size)
+        self.progress_manager.update(self.task, completed=self.m3u8_manager.completed / len(self.segments))
+
     def __concat_temp(self) -> None:
         """Concatenate temp files"""
         # We don't want to reset the elapsed time, so we don't reset the progress bar
         self.progress_manager.update(self.task, description='Concatenating video', completed=0)
 
-        with open(f'{self.output}.ts', 'wb') as f:
-            for segment in self.target_video.segments:
-                with open(f'{self.m3u8_manager.temp}/{self.target_video.segments.index(segment)}.ts', 'rb') as s:
-                    f.write(s.read())
-
-                percentage = (self.target_video.segments.index(segment) + 1) / len(self.target_video.segments)
-                self.progress_manager.update(self.task, completed=percentage)
-
+        # progress is reported by bytes, segments may differ a lot in size
+        sizes = [os.stat(self.__segment_path(segment)).st_size for segment in self.segments]
+        total = sum(sizes) or 1
+        copied = 0
+
+        # both files unbuffered, the data is copied by the kernel and never reaches python
+        with self.metrics.time('stage_seconds', stage='concat'), open(f'{self.output}.ts', 'wb', buffering=0) as f:
+            for segment, size in zip(self.segments, sizes):
+                with open(self.__segment_path(segment), 'rb', buffering=0) as s:
+                    for n in copy_into(s, f, size):
+                        copied += n
+                        self.progress_manager.update(self.task, completed=copied / total)
+
+    def __post_process(self) -> None:
+        """Transcode video and remove temp files"""
         # This question may not be asked by design
         if self.transcode is None:
             # must stop live to prevent prompt not showing
@@ -244,29 +691,40 @@ class M3U8Downloader(object):
                                   choices=['Yes', 'No'], default='Yes')
                 ])['transcode'] == 'Yes' else False
 
-        if self.transcode:
+        if self.write_mode == 'pipe':
+            # every segment is already in ffmpeg, wait for it to flush the output
+            self.progress_manager.update(self.task, description='Transcoding video', completed=0)
+
+            with self.metrics.time('stage_seconds', stage='transcode'):
+                self.__wait_transcode(self.transcoder.finish())
+            self.transcoder = None
+        elif self.transcode:
             # update progress bar
             self.progress_manager.update(self.task, description='Transcoding video', completed=0)
 
             _input = Path(f'{self.output}.ts')
             _output = f'{_input.parent.joinpath(_input.stem)}.mp4'
 
-            ffmpeg = FFMPEG(self.ffmpeg).run(str(_input), _output, self.vcodec, self.acodec, self.ffmpeg_options)
-
-            while True:
-                n = next(ffmpeg)
-                if n is not None:
-                    self.progress_manager.update(self.task, completed=n)
-                else:
-                    _input.unlink()  # remove original file
-                    self.progress_manager.update(self.task, completed=1)
-                    break
+            with self.metrics.time('stage_seconds', stage='transcode'):
+                ffmpeg = FFMPEG(self.ffmpeg).run(str(_input), _output, self.vcodec, self.acodec, self.ffmpeg_options)
+                self.__wait_transcode(ffmpeg)
+            _input.unlink()  # remove original file
 
         self.progress_manager.update(self.task, description='Removing temp files', completed=0, total=None)
         self.m3u8_manager.remove_temp()
         self.progress_manager.update(self.task, description='done!', completed=1)
         self.done = True
 
+    def __wait_transcode(self, ffmpeg: Iterator[float]) -> None:
+        """Update progress bar until ffmpeg is done"""
+        while True:
+            n = next(ffmpeg)
+            if n is not None:
+                self.progress_manager.update(self.task, completed=n)
+            else:
+                self.progress_manager.update(self.task, completed=1)
+                break
+
 
 if __name__ == '__main__':
     raise RuntimeError('This file is not intended to be run as a standalone script.')
@@ -1,34 +1,77 @@
+import os
+import time
+import zlib
 import pathlib
-from typing import Tuple
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional
 
 from m3u8 import model
-from tinydb import TinyDB, Query
+import json
 import pickle
+import sqlite3
 import inquirer
 from rich.progress import TaskID
 from rich.panel import Panel
-from api.api import NCP
-import time
+from api.api import NCP, ChannelID, ContentCode
 
 from util.progress import ProgressManager
 
 
 class M3U8Manager(object):
+    """
+    Segment status of a video download
+
+    Completed segments are appended to a journal of fixed-size records, so marking a segment as done
+    costs one small write no matter how long the playlist is. The journal is rebuilt with a single
+    sequential read on resume, a torn record left by a crash is dropped, and duplicates are compacted.
+
+    Each record keeps the size and crc32 of the segment, so a resumed task can check the data it is about to
+    trust (see verify_segments and verify_prefix). Journals of version 1 have no crc32, only their sizes are checked.
+
+    Args:
+        output (str): output file
+        resume (bool, optional): resume download. Defaults to None.
+    """
+    JOURNAL_MAGIC = b'NCPJ'
+    JOURNAL_VERSION = 2
+    JOURNAL_HEADER = struct.Struct('<4sHI')  # magic, version, number of segments
+    JOURNAL_RECORD = struct.Struct('<IQI?')  # segment index, segment size, crc32, crc32 is known
+    JOURNAL_RECORD_V1 = struct.Struct('<IQ')  # segment index, segment size
+
+    TS_PACKET_SIZE = 188
+    TS_SYNC_BYTE = b'\x47'
+    VERIFY_CHUNK_SIZE = 1024 * 1024  # bytes read at once by the full checksum
+
     def __init__(self, output: str, resume: bool = None):
         self.output = pathlib.Path(output)
         self.resume = resume
         self.temp = self.output.parent.joinpath(f'temp_{self.output.stem}')
-        self.segment_db_path = self.output.parent.joinpath(f'temp_{self.output.stem}/{self.output.stem}.pickle')
+        self.segment_db_path = self.temp.joinpath(f'{self.output.stem}.journal')
+        self.legacy_db_path = self.temp.joinpath(f'{self.output.stem}.pickle')  # used before the journal
 
         self.segment_db = None
+        self.segment_size = None
+        self.segment_crc = None  # crc32 of each segment, None if it is not known
 
-        if not self.output.parent.exists():
-            self.output.parent.mkdir(parents=True)
+        # running counters, so progress never has to sum the whole status list
+        self.completed = 0
+        self.completed_bytes = 0
+
+        self.journal = None
+        self.lock = threading.Lock()
+        self.continued = False  # <--- whether the last init_manager continued the journal
+
+        # videos of a channel downloaded at once share the output directory, any of them may create it
+        self.output.parent.mkdir(parents=True, exist_ok=True)
         if not self.temp.exists():
             self.temp.mkdir()
 
     def init_manager(self, segment_list: model.SegmentList) -> float:
-        if self.resume is None and self.segment_db_path.exists():
+        exists = self.segment_db_path.exists() or self.legacy_db_path.exists()
+
+        if self.resume is None and exists:
             questions = [
                 inquirer.List('resume', message='Found existing task, do you want to continue?',
                               choices=['Yes', 'No'], default='Yes')
@@ -36,10 +79,13 @@ class M3U8Manager(object):
             answer = inquirer.prompt(questions)['resume']
             self.resume = True if answer == 'Yes' else False
 
+        self.close()
+
         # resume download
-        if self.segment_db_path.exists() and self.resume:
-            # load the list of segment status
-            db = pickle.load(open(self.segment_db_path, 'rb'))
+        loaded = self.__load_journal(len(segment_list)) if exists and self.resume else None
+        self.continued = loaded is not None
+        if loaded is not None:
+            self.segment_db, self.segment_size, self.segment_crc = loaded
         # new download
         else:
             if self.temp.exists():
@@ -50,23 +96,233 @@ class M3U8Manager(object):
                 self.temp.joinpath('__DO NOT TOUCH FILES HERE__').mkdir()
 
             # initial the list of segment status
-            db = [False] * len(segment_list)
-            # dump the list to pickle file
-            pickle.dump(db, open(self.segment_db_path, 'wb'))
+            self.segment_db = [False] * len(segment_list)
+            self.segment_size = [0] * len(segment_list)
+            self.segment_crc = [None] * len(segment_list)
+            self.__write_journal()
+
+        self.completed = sum(self.segment_db)
+        self.completed_bytes = sum(self.segment_size)
 
-        # set the segment_db
-        self.segment_db = db
+        # the journal is our own state from now on, so the next round (if any) continues it
+        self.resume = True
 
-        return sum(self.segment_db) / len(segment_list)
+        self.journal = open(self.segment_db_path, 'ab', buffering=0)
+
+        return self.completed / len(segment_list)
 
     def get_status(self, segment_id: int) -> bool:
         return self.segment_db[segment_id]
 
-    def set_status(self, segment_id: int, status: bool) -> None:
-        self.segment_db[segment_id] = status
-        pickle.dump(self.segment_db, open(self.segment_db_path, 'wb'))
+    def set_status(self, segment_id: int, status: bool, size: int = 0, crc: Optional[int] = None) -> None:
+        with self.lock:
+            if status:
+                # a single unbuffered append, so a crash can at most tear the last record
+                self.journal.write(self.JOURNAL_RECORD.pack(segment_id, size, crc or 0, crc is not None))
+                self.completed += 0 if self.segment_db[segment_id] else 1
+                self.completed_bytes += size - self.segment_size[segment_id]
+                self.segment_db[segment_id] = True
+                self.segment_size[segment_id] = size
+                self.segment_crc[segment_id] = crc
+            elif self.segment_db[segment_id]:
+                # records can not be taken back, rewrite the journal without it
+                self.__reset_segments([segment_id])
+                self.__rewrite_journal()
+
+    def segment_path(self, segment_id: int) -> pathlib.Path:
+        """Temp file of a segment (temp write mode)"""
+        return self.temp.joinpath(f'{segment_id}.ts')
+
+    def verify_segments(self, full: bool = False) -> int:
+        """
+        Check the temp files of completed segments, the ones that fail are marked as not downloaded
+
+        Sizes come from a single directory scan. Each file is then opened once to sample the MPEG-TS sync byte
+        of its first, middle and last packet, and with full, to compare its crc32 with the journal.
+        Return the number of segments to download again.
+
+        Args:
+            full (bool, optional): also compare checksums, reading every file. Defaults to False.
+        """
+        with os.scandir(self.temp) as entries:
+            sizes = {entry.name: entry.stat().st_size for entry in entries if entry.is_file()}
+
+        failed = []
+        for segment_id, done in enumerate(self.segment_db):
+            if not done:
+                continue
+
+            size = sizes.get(f'{segment_id}.ts')
+            expected = self.segment_size[segment_id]
+            if size is None or size == 0 or (expected and size != expected):
+                failed.append(segment_id)  # <--- missing or truncated, tasks from before the journal have no size
+                continue
+
+            with open(self.segment_path(segment_id), 'rb') as f:
+                if not self.__check_segment(f, 0, size, self.segment_crc[segment_id] if full else None):
+                    failed.append(segment_id)
+
+        if failed:
+            with self.lock:
+                self.__reset_segments(failed)
+                self.__rewrite_journal()
+
+        return len(failed)
+
+    def verify_prefix(self, path: pathlib.Path, count: int, full: bool = False) -> Tuple[int, int]:
+        """
+        Check the leading run of completed segments written in order into one file (direct write mode),
+        keep only the segments before the first that fails
+
+        Return the number of kept segments and their total size, like keep_prefix.
+
+        Args:
+            path (pathlib.Path): output file
+            count (int): number of segments in the leading run, see keep_prefix
+            full (bool, optional): also compare checksums, reading the whole prefix. Defaults to False.
+        """
+        offset = 0
+        with open(path, 'rb') as f:
+            for segment_id in range(count):
+                size = self.segment_size[segment_id]
+                if not self.__check_segment(f, offset, size, self.segment_crc[segment_id] if full else None):
+                    return self.keep_prefix(segment_id)
+                offset += size
+
+        return self.keep_prefix(count)
+
+    def keep_prefix(self, limit: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Keep only the leading run of completed segments (at most limit segments)
+
+        Used when segments are written straight into the output file, which is only valid up to the first gap.
+        Return the number of kept segments and their total size.
+        """
+        with self.lock:
+            count = 0
+            while count < len(self.segment_db) and self.segment_db[count] and (limit is None or count < limit):
+                count += 1
+
+            if self.completed != count:
+                self.__reset_segments(range(count, len(self.segment_db)))
+                self.__rewrite_journal()
+
+            self.completed = count
+            self.completed_bytes = sum(self.segment_size[:count])
+
+            return self.completed, self.completed_bytes
+
+    def is_done(self) -> bool:
+        return self.completed == len(self.segment_db)
+
+    def close(self) -> None:
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def __reset_segments(self, segment_ids) -> None:
+        """Mark segments as not downloaded, the caller holds the lock and rewrites the journal"""
+        for segment_id in segment_ids:
+            if self.segment_db[segment_id]:
+                self.completed -= 1
+                self.completed_bytes -= self.segment_size[segment_id]
+            self.segment_db[segment_id] = False
+            self.segment_size[segment_id] = 0
+            self.segment_crc[segment_id] = None
+
+    def __check_segment(self, f, offset: int, size: int, crc: Optional[int]) -> bool:
+        """
+        Check a segment stored at offset of an open file
+
+        The sync byte must start its first, middle and last packet. If crc is given, the data must match it.
+        """
+        packets = max(size // self.TS_PACKET_SIZE, 1)
+        for packet in {0, packets // 2, packets - 1}:
+            f.seek(offset + packet * self.TS_PACKET_SIZE)
+            if f.read(1) != self.TS_SYNC_BYTE:
+                return False
+
+        if crc is None:
+            return True
+
+        f.seek(offset)
+        remaining, checksum = size, 0
+        while remaining > 0:
+            chunk = f.read(min(self.VERIFY_CHUNK_SIZE, remaining))
+            if not chunk:
+                return False  # <--- shorter than recorded
+            checksum = zlib.crc32(chunk, checksum)
+            remaining -= len(chunk)
+
+        return checksum == crc
+
+    def __load_journal(self, total: int) -> Optional[Tuple[list, list, list]]:
+        """Rebuild segment status from the journal, return None if there is nothing usable"""
+        # tasks created before the journal was introduced
+        if not self.segment_db_path.exists():
+            db = pickle.load(open(self.legacy_db_path, 'rb'))
+            if len(db) != total:
+                return None
+
+            self.segment_db, self.segment_size, self.segment_crc = db, [0] * total, [None] * total
+            self.__write_journal()
+            self.legacy_db_path.unlink()
+
+            return self.segment_db, self.segment_size, self.segment_crc
+
+        with open(self.segment_db_path, 'rb') as f:
+            data = f.read()
+
+        if len(data) < self.JOURNAL_HEADER.size:
+            return None
+
+        magic, version, count = self.JOURNAL_HEADER.unpack_from(data)
+        if magic != self.JOURNAL_MAGIC or version not in (1, self.JOURNAL_VERSION) or count != total:
+            return None  # unknown journal or the playlist has changed
+
+        # drop the torn record at the end (if any)
+        record = self.JOURNAL_RECORD if version == self.JOURNAL_VERSION else self.JOURNAL_RECORD_V1
+        records = (len(data) - self.JOURNAL_HEADER.size) // record.size
+        end = self.JOURNAL_HEADER.size + records * record.size
+
+        db = [False] * total
+        sizes = [0] * total
+        crcs = [None] * total
+        for segment_id, size, *checksum in record.iter_unpack(data[self.JOURNAL_HEADER.size:end]):
+            if segment_id < total:
+                db[segment_id] = True
+                sizes[segment_id] = size
+                crcs[segment_id] = checksum[0] if checksum and checksum[1] else None
+
+        self.segment_db, self.segment_size, self.segment_crc = db, sizes, crcs
+
+        # compact the journal if it has torn or duplicated records, or upgrade it to the current version
+        if end != len(data) or records != sum(db) or version != self.JOURNAL_VERSION:
+            self.__write_journal()
+
+        return db, sizes, crcs
+
+    def __rewrite_journal(self) -> None:
+        """Compact the journal while it is open for appending"""
+        self.journal.close()
+        self.__write_journal()
+        self.journal = open(self.segment_db_path, 'ab', buffering=0)
+
+    def __write_journal(self) -> None:
+        """Write a compacted journal of the current status"""
+        temp = self.segment_db_path.with_suffix('.tmp')
+        with open(temp, 'wb') as f:
+            f.write(self.JOURNAL_HEADER.pack(self.JOURNAL_MAGIC, self.JOURNAL_VERSION, len(self.segment_db)))
+            f.write(b''.join(self.JOURNAL_RECORD.pack(segment_id, self.segment_size[segment_id],
+                                                      self.segment_crc[segment_id] or 0,
+                                                      self.segment_crc[segment_id] is not None)
+                             for segment_id, done in enumerate(self.segment_db) if done))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.segment_db_path)
 
     def remove_temp(self, remove_self: bool = True) -> None:
+        self.close()  # close journal before removing temp folder
         for sub in self.temp.iterdir():
             if sub.is_dir():
                 for file in sub.iterdir():
@@ -78,27 +334,60 @@ class M3U8Manager(object):
 
 
 class ChannelManager(object):
-    def __init__(self, api_client: NCP, output: str, select_manually: bool, progress_manager: ProgressManager, wait, resume):
+    """
+    Video status of a channel download
+
+    Stored in an sqlite database (WAL mode) keyed by content code, so every lookup is an index hit and every
+    update writes a single row. Tasks created with the former TinyDB store (temp/<channel>.json) are imported.
+
+    Without a video list, the channel is listed by the manager. The newest video of the listing is kept as the
+    high-water mark of the channel, an incremental sync only lists the videos newer than it (usually a single
+    page) and a full listing reconciles the database every full_sync_interval seconds.
+    The mark lives in the database of the task, so a new task always starts with a full listing.
+
+    Args:
+        api_client (NCP): NCP object
+        output (str): output directory of the channel
+        select_manually (bool): manually select videos to download
+        progress_manager (ProgressManager): progress manager
+        resume (bool): resume download
+        channel_id (ChannelID, optional): channel id, needed to list the channel. Defaults to None.
+        incremental (bool, optional): list only the videos newer than the high-water mark. Defaults to False.
+        full_sync_interval (float, optional): seconds between two full listings of an incremental sync.
+            Defaults to 24 hours.
+    """
+    BATCH_SIZE = 50  # videos inserted per transaction while initializing the database
+    PREFETCH_WORKERS = 4  # concurrent requests for titles missing from the video list
+
+    def __init__(self, api_client: NCP, output: str, select_manually: bool, progress_manager: ProgressManager, resume,
+                 channel_id: ChannelID = None, incremental: bool = False, full_sync_interval: float = 24 * 3600):
         self.api_client = api_client
         self.output = pathlib.Path(output)
         self.select_manually = select_manually
         self.progress_manager = progress_manager
-        self.wait = wait
         self.resume = resume
+        self.channel_id = channel_id
+        self.incremental = incremental
+        self.full_sync_interval = full_sync_interval
         self.temp = self.output.parent.joinpath('temp')
-        self.channel_db_path = self.temp.joinpath(f'{self.output.stem}.json')
+        self.channel_db_path = self.temp.joinpath(f'{self.output.stem}.sqlite')
+        self.legacy_db_path = self.temp.joinpath(f'{self.output.stem}.json')  # used before sqlite
 
         self.channel_db = None
+        self.lock = threading.Lock()
 
         self.continue_exists_video = None
+        self.video_list = None  # videos of the task, known once the manager is initialized
 
         if not self.output.parent.exists():
             self.output.parent.mkdir(parents=True)
         if not self.temp.exists():
             self.temp.mkdir()
 
-    def init_manager(self, video_list: list, task: TaskID) -> Tuple[int, int]:
-        if self.resume is None and self.channel_db_path.exists():
+    def init_manager(self, video_list: Optional[list], task: TaskID) -> Tuple[int, int]:
+        exists = self.channel_db_path.exists() or self.legacy_db_path.exists()
+
+        if self.resume is None and exists:
             with self.progress_manager.pause():
                 answer = inquirer.prompt([
                     inquirer.List('resume', message='Found existing task, do you want to continue?',
@@ -115,57 +404,157 @@ class ChannelManager(object):
         selected = self.__select_videos()  # select videos(if select manually, otherwise return selected videos from db)
 
         self.progress_manager.live.console.print(
-            Panel(f'Found {len(video_list)} videos, {count_new} new videos added, '
+            Panel(f'Found {len(self.video_list)} videos, {count_new} new videos added, '
                   f'{sum(1 for _ in selected)} videos selected.',
                   title='Info'))
 
-        return len(self.channel_db.search(Query().done == True)), len(video_list)
+        with self.lock:
+            done = self.channel_db.execute('SELECT COUNT(*) FROM videos WHERE done = 1').fetchone()[0]
+
+        return done, len(self.video_list)
+
+    def __open_database(self) -> sqlite3.Connection:
+        """Open (or create) the database, import the former TinyDB store if there is one"""
+        migrate = not self.channel_db_path.exists() and self.legacy_db_path.exists()
+
+        # videos may be downloaded concurrently, access is serialized by self.lock
+        db = sqlite3.connect(self.channel_db_path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS videos (id TEXT PRIMARY KEY, title TEXT NOT NULL, done INTEGER)')
+        db.execute('CREATE TABLE IF NOT EXISTS sync (id INTEGER PRIMARY KEY CHECK (id = 0), content_code TEXT, '
+                   'display_date TEXT, full_sync_at REAL)')  # high-water mark of the channel, a single row
+
+        if migrate:
+            with open(self.legacy_db_path, 'r', encoding='utf-8') as f:
+                table = json.load(f).get('_default', {})
+
+            # keep the order of the former store, rowid follows the insertion order
+            with db:
+                db.executemany('INSERT OR IGNORE INTO videos (id, title, done) VALUES (?, ?, ?)',
+                               [(video['id'], video['title'], video['done'])
+                                for _, video in sorted(table.items(), key=lambda item: int(item[0]))])
+
+            self.legacy_db_path.rename(self.legacy_db_path.with_suffix('.json.migrated'))
+
+        return db
 
     def __init_database(self, video_list: list, task: TaskID) -> int:
         # if not resume, remove the temp folder
-        if not self.resume and self.channel_db_path.exists():
+        if not self.resume and (self.channel_db_path.exists() or self.legacy_db_path.exists()):
             self.remove_temp(False)
 
-        db = TinyDB(self.channel_db_path)
+        db = self.__open_database()
+        known = {row[0] for row in db.execute('SELECT id FROM videos')}
 
-        self.progress_manager.overall_update(task, total=len(video_list))
-        count_new = 0
-        for video in video_list:
-            if db.contains(Query().id == str(video)):
-                continue
+        partial, mark = False, None
+        if video_list is None:
+            video_list, mark, partial = self.__list_videos(db)
 
-            _, title = self.api_client.get_video_name(video)
-            db.insert({
-                'id': str(video),
-                'title': title,
-                'done': False
-            })
-            count_new += 1
-            time.sleep(self.wait)  # don't spam the server
+        new = []
+        for video in video_list:
+            if str(video) not in known:
+                known.add(str(video))
+                new.append(video)
 
-            self.progress_manager.overall_update(task, advance=1)
+        self.progress_manager.overall_update(task, total=len(video_list))
+        count_new = 0
+        batch = []
+
+        # titles from the video list need no request, the others are fetched concurrently (paced by the rate limiter)
+        executor = ThreadPoolExecutor(max_workers=self.PREFETCH_WORKERS)
+        try:
+            for video, (_, title) in zip(new, executor.map(self.api_client.get_video_name, new)):
+                batch.append((str(video), title, False))
+                count_new += 1
+
+                # insert in batches, so an interrupted initialization keeps most of the titles
+                if len(batch) >= self.BATCH_SIZE:
+                    with db:
+                        db.executemany('INSERT INTO videos (id, title, done) VALUES (?, ?, ?)', batch)
+                    batch.clear()
+
+                self.progress_manager.overall_update(task, advance=1)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # the mark is only moved once every video before it is in the database
+        with db:
+            db.executemany('INSERT INTO videos (id, title, done) VALUES (?, ?, ?)', batch)
+            if mark is not None:
+                db.execute('INSERT OR REPLACE INTO sync (id, content_code, display_date, full_sync_at) '
+                           'VALUES (0, ?, ?, ?)', mark)
 
         self.progress_manager.overall_update(task, description='done!')
 
         self.channel_db = db
 
+        # an incremental listing only has the newest videos, the others of the task come from the database
+        if partial:
+            codes = {str(video) for video in video_list}
+            rows = db.execute('SELECT id FROM videos ORDER BY rowid').fetchall()
+            video_list += [ContentCode(video_id) for video_id, in rows if video_id not in codes]
+        self.video_list = video_list
+
         return count_new
 
+    def __list_videos(self, db: sqlite3.Connection) -> Tuple[list, Optional[tuple], bool]:
+        """
+        List the videos of the channel, only the ones newer than the high-water mark unless a full listing is due
+
+        Return the videos, the new mark (content code, display date, time of the last full listing)
+        and whether the listing stopped at the mark.
+        """
+        row = db.execute('SELECT content_code, display_date, full_sync_at FROM sync').fetchone()
+        now = time.time()
+        full = not self.incremental or row is None or now - (row[2] or 0) >= self.full_sync_interval
+
+        if full:
+            videos = list(self.api_client.iter_videos(self.channel_id))
+        else:
+            code, date, _ = row
+            # stop at the newest known video, or at an older one if it has been removed since
+            videos = list(self.api_client.iter_videos(self.channel_id, until=lambda video: (
+                video['content_code'] == code or
+                (date is not None and self.__display_date(video) is not None and self.__display_date(video) < date))))
+
+        full_sync_at = now if full else row[2]
+        if videos:
+            mark = (videos[0]['content_code'], self.__display_date(videos[0]), full_sync_at)
+        else:
+            mark = (row[0], row[1], full_sync_at) if row is not None else None
+
+        return [ContentCode(video['content_code'], video) for video in videos], mark, not full
+
+    @staticmethod
+    def __display_date(video: dict) -> Optional[str]:
+        """Date the listing is sorted by ('YYYY-MM-DD HH:MM:SS', compares as a string)"""
+        return video.get('display_date') or video.get('released_at')
+
+    def __all(self) -> list:
+        """Get (id, title, done) of every video, in the order they were added"""
+        with self.lock:
+            return [(video_id, title, None if done is None else bool(done))
+                    for video_id, title, done in self.channel_db.execute('SELECT id, title, done FROM videos '
+                                                                         'ORDER BY rowid')]
+
     def __select_videos(self) -> list:
+        videos = self.__all()
+
         # return selected videos(from db) if not select manually
         if not self.select_manually:
-            if self.channel_db.search(Query().done == None):
+            if any(done is None for _, _, done in videos):
                 self.progress_manager.live.console.print('Warning: not all videos are selected. '
                                                          '(use --select-manually to select manually)', style='yellow')
 
-            return [video['id'] for video in self.channel_db.search(Query().done != None)]
+            return [video_id for video_id, _, done in videos if done is not None]
 
         # select videos to download
         with self.progress_manager.pause():
-            locked = [video['id'] for video in self.channel_db.search(Query().done == True)]
-            hints = {video['id']: video['title'] for video in self.channel_db.all()}
-            choices = [f'{video['id']}' for video in self.channel_db.all()]
-            default = [video['id'] for video in self.channel_db.search(Query().done != None)]
+            locked = [video_id for video_id, _, done in videos if done is True]
+            hints = {video_id: title for video_id, title, _ in videos}
+            choices = [video_id for video_id, _, _ in videos]
+            default = [video_id for video_id, _, done in videos if done is not None]
 
             selected = inquirer.prompt([
                 inquirer.Checkbox('videos', message='Select videos to download',
@@ -175,28 +564,39 @@ class ChannelManager(object):
                                   default=default)
             ], raise_keyboard_interrupt=True)['videos']
 
-        # set unselected videos to None(skip)
-        for video in set(choices) - set(selected):
-            self.channel_db.update({'done': None}, Query().id == video)
+        with self.lock, self.channel_db:
+            # set unselected videos to None(skip)
+            self.channel_db.executemany('UPDATE videos SET done = NULL WHERE id = ?',
+                                        [(video,) for video in set(choices) - set(selected)])
 
-        # set selected videos to False(not done)
-        for video in set(selected) - set(default):
-            self.channel_db.update({'done': False}, Query().id == video)
+            # set selected videos to False(not done)
+            self.channel_db.executemany('UPDATE videos SET done = 0 WHERE id = ?',
+                                        [(video,) for video in set(selected) - set(default)])
 
         return selected
 
     def get_title(self, content_code: str) -> str:
-        return self.channel_db.get(Query().id == content_code)['title']
+        with self.lock:
+            return self.channel_db.execute('SELECT title FROM videos WHERE id = ?', (content_code,)).fetchone()[0]
 
-    def get_status(self, content_code: str) -> bool:
-        return self.channel_db.get(Query().id == content_code)['done']
+    def get_status(self, content_code: str) -> Optional[bool]:
+        with self.lock:
+            done = self.channel_db.execute('SELECT done FROM videos WHERE id = ?', (content_code,)).fetchone()[0]
+            return None if done is None else bool(done)
 
-    def set_status(self, content_code: str, status: bool) -> None:
-        self.channel_db.update({'done': status}, Query().id == content_code)
+    def set_status(self, content_code: str, status: Optional[bool]) -> None:
+        with self.lock, self.channel_db:
+            self.channel_db.execute('UPDATE videos SET done = ? WHERE id = ?', (status, content_code))
 
     def remove_temp(self, remove_self: bool = True) -> None:
-        self.channel_db.close() if remove_self else None  # close db before removing temp folder
-        self.channel_db_path.unlink()
+        if self.channel_db is not None:
+            self.channel_db.close()  # close db before removing temp folder
+            self.channel_db = None
+
+        for path in (self.channel_db_path, self.legacy_db_path, self.legacy_db_path.with_suffix('.json.migrated'),
+                     self.channel_db_path.with_name(f'{self.channel_db_path.name}-wal'),
+                     self.channel_db_path.with_name(f'{self.channel_db_path.name}-shm')):
+            path.unlink(missing_ok=True)
 
 
 if __name__ == '__main__':
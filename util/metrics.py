@@ -0,0 +1,215 @@
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Optional
+
+# upper bounds (seconds) of the latency histogram buckets, the last bucket is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_NULL_CONTEXT = nullcontext()
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets"""
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate quantile as the upper bound of the bucket it falls in (None if it is in +Inf)"""
+        if self.count == 0:
+            return None
+
+        rank, seen = q * self.count, 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return None
+
+
+class Stopwatch(object):
+    """
+    Accumulate the time spent in a repeated step (e.g. decrypting the chunks of a segment), record it once at the end
+
+    Args:
+        metrics (Metrics): registry to record to
+        name (str): histogram name
+        labels (dict): histogram labels
+    """
+    def __init__(self, metrics: 'Metrics', name: str, labels: dict) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.elapsed = 0.0
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed += time.perf_counter() - self.started
+
+    def record(self) -> None:
+        self.metrics.observe(self.name, self.elapsed, **self.labels)
+
+
+class _NullStopwatch(object):
+    """Stopwatch of disabled metrics, does nothing"""
+    elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def record(self) -> None:
+        pass
+
+
+_NULL_STOPWATCH = _NullStopwatch()
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms of the download pipeline
+
+    Every hook returns right away when the metrics are disabled, so instrumented code pays next to nothing.
+    The results can be exported as a Prometheus textfile (for the node exporter textfile collector)
+    and as a JSON summary.
+
+    Args:
+        enabled (bool, optional): record metrics. Defaults to True.
+        prefix (str, optional): prefix of every metric name. Defaults to 'ncp_'.
+    """
+    def __init__(self, enabled: bool = True, prefix: str = 'ncp_') -> None:
+        self.enabled = enabled
+        self.prefix = prefix
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Increase counter"""
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """Record a latency in histogram"""
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def time(self, name: str, **labels):
+        """Context manager recording the time spent in the block in histogram"""
+        if not self.enabled:
+            return _NULL_CONTEXT
+
+        return _Timer(self, name, labels)
+
+    def stopwatch(self, name: str, **labels):
+        """Stopwatch accumulating time over several blocks, recorded in histogram by record()"""
+        if not self.enabled:
+            return _NULL_STOPWATCH
+
+        return Stopwatch(self, name, labels)
+
+    def to_prometheus(self) -> str:
+        """Render metrics in the Prometheus text exposition format"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self.histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            name = f'{self.prefix}{name}'
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{self.__labels(labels)} {value}')
+
+        for (name, labels), (counts, total, count) in histograms:
+            name = f'{self.prefix}{name}'
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+
+            cumulative = 0
+            for bound, bucket in zip((*BUCKETS, '+Inf'), counts):
+                cumulative += bucket
+                le = bound if isinstance(bound, str) else f'{bound:g}'
+                lines.append(f'{name}_bucket{self.__labels((*labels, ("le", le)))} {cumulative}')
+            lines.append(f'{name}_sum{self.__labels(labels)} {total}')
+            lines.append(f'{name}_count{self.__labels(labels)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        """Summarize metrics, histograms as count, sum, mean and estimated p50/p99"""
+        with self.lock:
+            counters = [(name, dict(labels), value) for (name, labels), value in sorted(self.counters.items())]
+            histograms = [(name, dict(labels), h.count, h.sum, h.quantile(0.5), h.quantile(0.99))
+                          for (name, labels), h in sorted(self.histograms.items())]
+
+        return {
+            'started': self.started,
+            'duration_s': round(time.time() - self.started, 3),
+            'counters': [{'name': name, 'labels': labels, 'value': value} for name, labels, value in counters],
+            'histograms': [{'name': name, 'labels': labels, 'count': count, 'sum_s': round(total, 6),
+                            'mean_s': round(total / count, 6) if count else None, 'p50_le_s': p50, 'p99_le_s': p99}
+                           for name, labels, count, total, p50, p99 in histograms],
+        }
+
+    def write_textfile(self, path: str or Path) -> None:
+        """Write Prometheus textfile, atomically so the collector never reads half a file"""
+        path = Path(path)
+        temp = path.with_name(f'{path.name}.tmp')
+        temp.write_text(self.to_prometheus())
+        temp.replace(path)
+
+    def write_json(self, path: str or Path) -> None:
+        """Write JSON summary"""
+        Path(path).write_text(json.dumps(self.summary(), indent=2))
+
+    @staticmethod
+    def __labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+class _Timer(Stopwatch):
+    """Context manager of Metrics.time, records when the block exits"""
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super().__exit__(exc_type, exc_val, exc_tb)
+        self.record()
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
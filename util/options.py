@@ -0,0 +1,38 @@
+from enum import Enum
+
+# choices shared by the command line, the queue mode and the benchmarks
+# only the standard library is imported here, main.py imports this module before parsing the arguments
+
+
+class Engine(str, Enum):
+    thread = 'thread'
+    asyncio = 'asyncio'
+
+
+class WriteMode(str, Enum):
+    temp = 'temp'
+    direct = 'direct'
+    pipe = 'pipe'
+
+
+class DecryptMode(str, Enum):
+    inline = 'inline'
+    thread = 'thread'
+    process = 'process'
+
+
+def parse_resolution(value: str) -> tuple:
+    """Parse a resolution given as 'WIDTHxHEIGHT' (e.g. '1920x1080'), raise ValueError if it is not one"""
+    try:
+        resolution = tuple(map(int, value.split('x')))
+    except ValueError:
+        resolution = ()
+
+    if len(resolution) != 2 or min(resolution) <= 0:
+        raise ValueError(f'Invalid resolution: {value}.')
+
+    return resolution
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
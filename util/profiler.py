@@ -0,0 +1,144 @@
+import io
+import sys
+import pstats
+import cProfile
+import sysconfig
+import threading
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+STDLIB = Path(sysconfig.get_paths()['stdlib']).resolve()
+
+# modules shown first in the per-module breakdown, everything else follows by time
+WATCHED_MODULES = ('api/', 'util/m3u8_downloader.py', 'util/manager.py', 'rich')
+
+
+class Profiler(object):
+    """
+    CPU and allocation profile of a run
+
+    Writes to the output directory:
+        cpu.pstats: cProfile stats of every thread (load with pstats or snakeviz)
+        cpu.txt: top functions by cumulative time
+        modules.txt: time spent in each module (api/, util/m3u8_downloader.py, util/manager.py, rich, ...)
+        allocations.txt: top allocation sites still alive at the end of the run, and the peak traced memory
+
+    Since python 3.12 one profiler sees every thread (sys.monitoring). Before that each thread needs its own,
+    so new threads (e.g. the segment workers) start one through threading.setprofile and they are merged at the end.
+
+    Args:
+        output (Path): output directory
+        top (int, optional): number of entries in cpu.txt and allocations.txt. Defaults to 40.
+        frames (int, optional): frames stored per allocation traceback. Defaults to 10.
+    """
+    def __init__(self, output: Path, top: int = 40, frames: int = 10) -> None:
+        self.output = Path(output)
+        self.top = top
+        self.frames = frames
+
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.per_thread = sys.version_info < (3, 12)
+
+    def start(self) -> None:
+        """Start profiling, threads started from now on are profiled as well"""
+        tracemalloc.start(self.frames)
+
+        if self.per_thread:
+            threading.setprofile(self.__start_thread)
+
+        self.__start_profile()
+
+    def stop(self) -> None:
+        """Stop profiling and write the results"""
+        if self.per_thread:
+            threading.setprofile(None)
+
+        with self.lock:
+            for profile in self.profiles:
+                profile.disable()  # worker threads are done by now, only the main thread is still profiled
+
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.output.mkdir(parents=True, exist_ok=True)
+
+        stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(self.output.joinpath('cpu.pstats'))
+
+        report = io.StringIO()
+        pstats.Stats(*self.profiles, stream=report).sort_stats('cumulative').print_stats(self.top)
+        self.output.joinpath('cpu.txt').write_text(report.getvalue())
+
+        self.output.joinpath('modules.txt').write_text(self.__module_breakdown(stats))
+        self.output.joinpath('allocations.txt').write_text(self.__allocations(snapshot, peak))
+
+    def __start_thread(self, frame, event, arg) -> None:
+        """Profile hook of new threads, replace itself with a profiler of the thread"""
+        sys.setprofile(None)
+        self.__start_profile()
+
+    def __start_profile(self) -> None:
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def __module_breakdown(self, stats: pstats.Stats) -> str:
+        """Own time (tottime) and calls per module"""
+        modules = {}
+        for (filename, _, _), (_, calls, tottime, _, _) in stats.stats.items():
+            module = self.__module(filename)
+            total, count = modules.get(module, (0.0, 0))
+            modules[module] = (total + tottime, count + calls)
+
+        total = sum(tottime for tottime, _ in modules.values()) or 1
+        watched = [module for module in WATCHED_MODULES if module in modules]
+        others = sorted((module for module in modules if module not in WATCHED_MODULES),
+                        key=lambda module: modules[module][0], reverse=True)
+
+        lines = [f'{"module":<40}{"tottime (s)":>14}{"share":>8}{"calls":>12}']
+        for module in [*watched, *others]:
+            tottime, calls = modules[module]
+            lines.append(f'{module:<40}{tottime:>14.3f}{tottime / total:>8.1%}{calls:>12}')
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __module(filename: str) -> str:
+        """Group a source file into api/, a file of this project, a third party package, stdlib or built-in"""
+        if filename == '~' or filename.startswith('<'):
+            return '<built-in>'
+
+        path = Path(filename).resolve()
+        if path.is_relative_to(ROOT) and 'site-packages' not in path.parts:
+            relative = path.relative_to(ROOT).as_posix()
+            return 'api/' if relative.startswith('api/') else relative
+
+        if 'site-packages' in path.parts:
+            parts = path.parts[path.parts.index('site-packages') + 1:]
+            return parts[0].removesuffix('.py') if parts else '<site-packages>'
+
+        if path.is_relative_to(STDLIB):
+            return '<stdlib>'
+
+        return filename
+
+    def __allocations(self, snapshot: tracemalloc.Snapshot, peak: int) -> str:
+        """Top allocation sites by size"""
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        statistics = snapshot.statistics('lineno')
+
+        lines = [f'peak traced memory: {peak / 1024 / 1024:.1f} MiB',
+                 f'still allocated at the end: {sum(stat.size for stat in statistics) / 1024 / 1024:.1f} MiB', '']
+        for stat in statistics[:self.top]:
+            frame = stat.traceback[0]
+            lines.append(f'{stat.size / 1024:>10.1f} KiB {stat.count:>8} blocks  {frame.filename}:{frame.lineno}')
+
+        return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
@@ -1,17 +1,98 @@
 from rich.progress import Progress, SpinnerColumn, TimeElapsedColumn, TextColumn, BarColumn, MofNCompleteColumn, TaskID
-from rich.console import Group
+from rich.console import Console, Group
 from rich.live import Live
 from contextlib import contextmanager
+from collections import deque
+from datetime import timedelta
+from typing import Optional
+import threading
+import time
+
+THROUGHPUT_WINDOW = 5.0  # seconds of samples behind the throughput and ETA
+
+
+class TaskStats:
+    """
+    Bytes, throughput and ETA of a task, computed from samples taken by the sampler
+
+    Args:
+        since_start (bool, optional): estimate the ETA from the progress since the first sample instead of
+            the window, for tasks progressing in large steps (e.g. one video at a time). Defaults to False.
+    """
+    def __init__(self, since_start: bool = False) -> None:
+        self.bytes = 0
+        self.completed = 0.0
+        self.total = None
+        self.samples = deque()  # (time, bytes, completed) over the last THROUGHPUT_WINDOW seconds
+        self.since_start = since_start
+        self.first = None  # first sample
+
+    def clear(self) -> None:
+        self.samples.clear()
+        self.first = None
+
+    def sample(self, now: float) -> None:
+        if self.first is None:
+            self.first = (now, self.bytes, self.completed)
+        self.samples.append((now, self.bytes, self.completed))
+        while len(self.samples) > 2 and now - self.samples[0][0] > THROUGHPUT_WINDOW:
+            self.samples.popleft()
+
+    def speed(self) -> Optional[float]:
+        """Bytes per second over the window"""
+        if len(self.samples) < 2 or self.samples[-1][0] <= self.samples[0][0]:
+            return None
+        (start, start_bytes, _), (end, end_bytes, _) = self.samples[0], self.samples[-1]
+        return (end_bytes - start_bytes) / (end - start)
+
+    def eta(self) -> Optional[float]:
+        """Seconds left at the progress rate of the window"""
+        if self.total is None or len(self.samples) < 2:
+            return None
+        (start, _, start_completed) = self.first if self.since_start else self.samples[0]
+        (end, _, end_completed) = self.samples[-1]
+        if end_completed <= start_completed or end <= start:
+            return None
+        return max(self.total - self.completed, 0) / ((end_completed - start_completed) / (end - start))
+
+    def describe(self) -> str:
+        """Human readable bytes, throughput and ETA"""
+        speed, eta = self.speed(), self.eta()
+        return ' '.join(filter(None, [
+            format_bytes(self.bytes) if self.bytes else None,
+            f'{format_bytes(speed)}/s' if speed is not None and self.bytes else None,
+            f'ETA {timedelta(seconds=int(eta))}' if eta is not None else None,
+        ]))
 
 
 class ProgressManager:
-    def __init__(self) -> None:
+    """
+    Progress of the downloads
+
+    Workers never touch the renderer: their updates are queued (deque appends need no lock) and a sampler thread
+    applies them in batches at a fixed refresh rate, together with the bytes, throughput and ETA of every task.
+    Outside of `with`, updates are applied right away.
+
+    Args:
+        refresh_per_second (float, optional): refresh rate of the renderer. Defaults to 10.
+        live (bool, optional): render live progress bars. Defaults to None (only if the output is a terminal,
+            otherwise a status line per task is logged every log_interval seconds).
+        log_interval (float, optional): seconds between status lines when not rendering live. Defaults to 10.
+    """
+    def __init__(self, refresh_per_second: float = 10, live: Optional[bool] = None,
+                 log_interval: float = 10) -> None:
+        self.console = Console()
+        self.refresh_per_second = refresh_per_second
+        self.live_enabled = self.console.is_terminal if live is None else live
+        self.log_interval = log_interval
+
         # This is for the overall progress
         self.overall_progress = Progress(
             SpinnerColumn(),
             TextColumn("[progress.description]{task.description}"),
             BarColumn(),
             MofNCompleteColumn(),
+            TextColumn("{task.fields[transfer]}"),
         )
         # This is for the individual progress
         self.progress = Progress(
@@ -19,6 +100,7 @@ class ProgressManager:
             *Progress.get_default_columns(),
             "Elapsed:",
             TimeElapsedColumn(),
+            TextColumn("{task.fields[transfer]}"),
         )
         # The rendering group
         # The overall progress is in the last one because we want to make it always visible
@@ -26,38 +108,63 @@ class ProgressManager:
             self.progress,
             self.overall_progress
         )
-        self.live = Live(self.group, refresh_per_second=10)
+        # refreshed by the sampler, not by a thread of its own
+        self.live = Live(self.group, console=self.console, auto_refresh=False)
+
+        self.events = deque()  # (method, progress, task, kwargs) queued by workers
+        self.stats = {}  # task id of self.progress -> TaskStats
+        self.overall_stats = {}  # task id of self.overall_progress -> TaskStats, counts the bytes of every task
+
+        self.sampler = None
+        self.stopped = threading.Event()
+        self.last_log = 0.0
 
     def add_overall_task(self, description: str, total: float | None = 100.0) -> TaskID:
-        return self.overall_progress.add_task(description, total=total)
+        task = self.overall_progress.add_task(description, total=total, transfer='')
+        self.overall_stats[task] = TaskStats(since_start=True)
+        return task
 
     def overall_reset(self, task: TaskID, description: str | None = None,
                       total: float | None = None, completed: float | None = None) -> None:
-        self.overall_progress.reset(task)  # <--- completed here doesn't accept float
+        self.__queue('reset', self.overall_progress, task)  # <--- completed here doesn't accept float
         self.overall_update(task, description=description, total=total, completed=completed)
 
     def overall_update(self, task: TaskID, description: str | None = None, total: float | None = None,
                        completed: float | None = None, advance: float | None = None) -> None:
-        self.overall_progress.update(task, description=description, total=total, completed=completed, advance=advance)
+        self.__queue('update', self.overall_progress, task, description=description, total=total,
+                     completed=completed, advance=advance)
 
     def add_task(self, description: str, total: float | None = 100.0) -> TaskID:
-        return self.progress.add_task(description, total=total)
+        task = self.progress.add_task(description, total=total, transfer='')
+        self.stats[task] = TaskStats()
+        return task
 
     def reset(self, task: TaskID, description: str | None = None,
               total: float | None = None, completed: float | None = None) -> None:
-        self.progress.reset(task)  # <--- completed here doesn't accept float
+        self.__queue('reset', self.progress, task)  # <--- completed here doesn't accept float
         self.update(task, description=description, total=total, completed=completed)
 
     def update(self, task: TaskID, description: str | None = None,
                total: float | None = None, completed: float | None = None, advance: float | None = None) -> None:
-        self.progress.update(task, description=description, total=total, completed=completed, advance=advance)
+        self.__queue('update', self.progress, task, description=description, total=total,
+                     completed=completed, advance=advance)
+
+    def advance_bytes(self, task: TaskID, size: int) -> None:
+        """Count bytes downloaded for the task, shown with throughput and ETA"""
+        self.__queue('bytes', self.progress, task, size=size)
 
     def stop_task(self, task: TaskID) -> None:
-        self.progress.stop_task(task)
-        self.progress.update(task, visible=False)
+        self.__queue('stop', self.progress, task)
+
+    def remove_task(self, task: TaskID) -> None:
+        self.__queue('remove', self.progress, task)
 
     @contextmanager
     def pause(self):
+        if not self.live_enabled:
+            yield  # <--- nothing is rendered, prompts can be shown as they are
+            return
+
         self.live.stop()  # <--- this stop the live rendering
 
         yield  # <--- this is where the code inside the with block run
@@ -66,11 +173,131 @@ class ProgressManager:
         self.live.console.clear()  # <--- this clear the console after the rendering
 
     def __enter__(self):
-        self.live.__enter__()
+        if self.live_enabled:
+            self.live.__enter__()
+
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self.__sample_loop, name='progress-sampler', daemon=True)
+        self.sampler.start()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.live.__exit__(exc_type, exc_val, exc_tb)
+        self.stopped.set()
+        self.sampler.join()
+        self.sampler = None
+
+        self.__sample()  # <--- the last events, so the final state is rendered
+        if self.live_enabled:
+            self.live.__exit__(exc_type, exc_val, exc_tb)
+        else:
+            self.__log()
+
+    def __queue(self, method: str, progress: Progress, task: TaskID, **kwargs) -> None:
+        self.events.append((method, progress, task, kwargs))
+        if self.sampler is None:
+            self.__apply_events()  # <--- nobody samples, apply right away
+
+    def __sample_loop(self) -> None:
+        while not self.stopped.wait(1 / self.refresh_per_second):
+            self.__sample()
+
+            if not self.live_enabled and time.monotonic() - self.last_log >= self.log_interval:
+                self.__log()
+
+    def __sample(self) -> None:
+        self.__apply_events()
+
+        now = time.monotonic()
+        for progress, stats in ((self.progress, self.stats), (self.overall_progress, self.overall_stats)):
+            for task, task_stats in list(stats.items()):
+                task_stats.sample(now)
+                progress.update(task, transfer=task_stats.describe())
+
+        if self.live_enabled and self.live.is_started:
+            self.live.refresh()
+
+    def __apply_events(self) -> None:
+        """Apply queued events, updates of a task are merged so the renderer is updated once per task"""
+        pending = {}  # (progress, task) -> merged update
+        while self.events:
+            try:
+                method, progress, task, kwargs = self.events.popleft()
+            except IndexError:
+                break  # <--- drained by another thread
+
+            key = (progress, task)
+            match method:
+                case 'update':
+                    merged = pending.setdefault(key, {})
+                    for name, value in kwargs.items():
+                        if value is None:
+                            continue
+                        if name == 'advance':
+                            merged['advance'] = merged.get('advance', 0) + value
+                        else:
+                            merged[name] = value
+                            if name == 'completed':
+                                merged.pop('advance', None)  # <--- an absolute value replaces earlier advances
+                case 'bytes':
+                    if task in self.stats:
+                        self.stats[task].bytes += kwargs['size']
+                    for stats in self.overall_stats.values():
+                        stats.bytes += kwargs['size']
+                case _:
+                    self.__flush(pending.pop(key, None), progress, task)
+                    self.__apply(method, progress, task)
+
+        for (progress, task), merged in pending.items():
+            self.__flush(merged, progress, task)
+
+    def __flush(self, merged: Optional[dict], progress: Progress, task: TaskID) -> None:
+        if not merged or task not in progress.task_ids:
+            return
+
+        progress.update(task, **merged)
+
+        stats = (self.stats if progress is self.progress else self.overall_stats).get(task)
+        if stats is not None:
+            rich_task = progress.tasks[progress.task_ids.index(task)]
+            stats.completed, stats.total = rich_task.completed, rich_task.total
+
+    def __apply(self, method: str, progress: Progress, task: TaskID) -> None:
+        if task not in progress.task_ids:
+            return
+
+        stats = self.stats if progress is self.progress else self.overall_stats
+        match method:
+            case 'reset':
+                progress.reset(task)
+                if task in stats:
+                    stats[task].clear()
+            case 'stop':
+                progress.stop_task(task)
+                progress.update(task, visible=False)
+            case 'remove':
+                progress.remove_task(task)
+                stats.pop(task, None)
+
+    def __log(self) -> None:
+        """Status line per visible task, for runs without a terminal"""
+        self.last_log = time.monotonic()
+        for progress in (self.progress, self.overall_progress):
+            for task in progress.tasks:
+                if not task.visible:
+                    continue
+                percentage = f'{task.percentage:.0f}%' if task.total else '-'
+                self.console.print(f'{task.description}: {percentage} {task.fields.get("transfer", "")}'.rstrip(),
+                                   highlight=False)
+
+
+def format_bytes(size: float) -> str:
+    """Format number of bytes with a binary unit"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            return f'{size:.1f} {unit}' if unit != 'B' else f'{size:.0f} {unit}'
+        size /= 1024
+
+    return f'{size:.1f} TiB'
 
 
 if __name__ == '__main__':
@@ -0,0 +1,36 @@
+import random
+
+# status codes meaning the hls session is no longer valid, retrying the same url will not help
+SESSION_EXPIRED_STATUS = {401, 403, 410}
+
+
+class RetryPolicy(object):
+    """
+    Retry policy of segment downloads
+
+    A failed segment is retried on its own with exponential backoff and full jitter, up to `attempts` times.
+    Segments still missing after that are retried in another round over the missing segments only,
+    at most `rounds` rounds per video.
+
+    Args:
+        attempts (int, optional): max attempts per segment in a round. Defaults to 5.
+        rounds (int, optional): max rounds over the missing segments. Defaults to 3.
+        base (float, optional): backoff of the first retry in seconds. Defaults to 0.5.
+        cap (float, optional): max backoff in seconds. Defaults to 30.
+    """
+    def __init__(self, attempts: int = 5, rounds: int = 3, base: float = 0.5, cap: float = 30.0) -> None:
+        self.attempts = max(attempts, 1)
+        self.rounds = max(rounds, 1)
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int) -> float:
+        """Backoff before the given attempt (the first attempt is 0 and never waits)"""
+        if attempt <= 0:
+            return 0.0
+
+        return random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
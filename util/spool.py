@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import uuid
+import socket
+from pathlib import Path
+from typing import Optional, IO
+
+try:
+    import fcntl
+except ImportError:  # windows
+    import msvcrt
+    fcntl = None
+
+
+class Job(object):
+    """
+    Download job of a spool
+
+    Args:
+        path (Path): job file
+        url (str): URL of the video or channel
+        output (str, optional): output directory. Defaults to None (output directory of the queue).
+        priority (int, optional): jobs with a higher priority run first. Defaults to 0.
+        options (dict, optional): download options, see JobOptions.from_dict. Defaults to None.
+    """
+    def __init__(self, path: Path, url: str, output: str = None, priority: int = 0, options: dict = None) -> None:
+        self.path = path
+        self.url = url
+        self.output = output
+        self.priority = priority
+        self.options = options or {}
+
+    @property
+    def name(self) -> str:
+        return self.path.stem
+
+
+class Spool(object):
+    """
+    Queue of download jobs in a directory
+
+    A job is a JSON file in the spool directory, e.g.
+        {"url": "https://...", "priority": 10, "output": "/data/videos", "options": {"thread": 2}}
+
+    Jobs with the highest priority run first, then the oldest. A job being run is moved to the directory of its
+    worker in running/, then to done/ or failed/ (with the error added to the file). Files are only ever moved by
+    rename, which is atomic, so a job is never run twice. Write job files under another name (e.g. *.tmp) and
+    rename them to *.json, like submit() does, so a half written file is never picked up.
+
+    A worker holds an exclusive lock on running/<worker>/.lock from register() to unregister(), the lock is
+    released by the system when the process dies. recover() puts back in the queue the jobs of the workers
+    whose lock can be taken, so several workers can share a spool without taking over each other's jobs.
+
+    Args:
+        path (str | Path): spool directory
+    """
+    def __init__(self, path: str or Path) -> None:
+        self.path = Path(path)
+        self.running = self.path.joinpath('running')
+        self.done = self.path.joinpath('done')
+        self.failed = self.path.joinpath('failed')
+
+        for directory in (self.path, self.running, self.done, self.failed):
+            directory.mkdir(parents=True, exist_ok=True)
+
+        self.owned = self.running  # <--- running/<worker> once registered
+        self.lock = None
+
+    def submit(self, url: str, output: str = None, priority: int = 0, options: dict = None) -> Path:
+        """Add a job to the queue"""
+        name = f'{time.strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        temp = self.path.joinpath(f'{name}.tmp')
+        temp.write_text(json.dumps({'url': url, 'output': output, 'priority': priority, 'options': options or {}},
+                                   indent=2))
+
+        return temp.replace(self.path.joinpath(f'{name}.json'))
+
+    def register(self) -> None:
+        """Create the running directory of this worker and lock it until unregister() or the process exits"""
+        name = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+        # locked under a hidden name first, so recover() never sees the directory unlocked
+        temp = self.running.joinpath(f'.{name}')
+        temp.mkdir()
+        self.lock = open(temp.joinpath('.lock'), 'a+')
+        if not self.__try_lock(self.lock):
+            raise RuntimeError(f'Could not lock {temp}.')
+
+        self.owned = temp.replace(self.running.joinpath(name))
+
+    def unregister(self) -> None:
+        """Put the jobs still owned back in the queue and remove the running directory of this worker"""
+        if self.lock is None:
+            return
+
+        owned, lock = self.owned, self.lock
+        self.owned, self.lock = self.running, None
+        self.__release(owned, lock)
+
+    def recover(self) -> int:
+        """Put the jobs of dead workers back in the queue, return their number"""
+        # left by a crash of a version without worker directories
+        count = self.__requeue_all(self.running)
+
+        for directory in self.running.iterdir():
+            if not directory.is_dir() or directory.name.startswith('.') or directory == self.owned:
+                continue
+
+            try:
+                lock = open(directory.joinpath('.lock'), 'a+')
+            except FileNotFoundError:
+                continue  # <--- recovered by another worker meanwhile
+
+            if not self.__try_lock(lock):
+                lock.close()
+                continue  # <--- the worker is alive
+
+            count += self.__release(directory, lock)
+
+        return count
+
+    def claim(self) -> Optional[Job]:
+        """Move the next job to running/ and return it, None if the queue is empty"""
+        queued = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith('.json'):
+                    continue
+
+                try:
+                    priority = json.loads(Path(entry.path).read_text()).get('priority', 0)
+                    queued.append((-int(priority), entry.stat().st_mtime, entry.name))
+                except FileNotFoundError:
+                    continue  # <--- claimed or removed meanwhile
+                except (ValueError, TypeError, AttributeError) as e:
+                    self.__reject(Path(entry.path), f'Invalid job file: {e}')
+
+        for _, _, name in sorted(queued):
+            path = self.owned.joinpath(name)
+            try:
+                self.path.joinpath(name).replace(path)
+            except FileNotFoundError:
+                continue  # <--- taken by another worker
+
+            data = json.loads(path.read_text())
+            if not isinstance(data.get('url'), str):
+                self.finish(Job(path, ''), 'Invalid job file: no url.')
+                continue
+
+            return Job(path, data['url'], data.get('output'), data.get('priority', 0), data.get('options'))
+
+        return None
+
+    def finish(self, job: Job, error: str = None) -> None:
+        """Move a job to done/, or to failed/ with the error"""
+        if error is None:
+            job.path.replace(self.done.joinpath(job.path.name))
+            return
+
+        self.__reject(job.path, error)
+
+    def requeue(self, job: Job) -> None:
+        """Put a job back in the queue (e.g. the queue is stopped while it runs)"""
+        job.path.replace(self.path.joinpath(job.path.name))
+
+    def __requeue_all(self, directory: Path) -> int:
+        """Put the jobs of a running directory back in the queue, return their number"""
+        count = 0
+        for path in directory.glob('*.json'):
+            try:
+                path.replace(self.path.joinpath(path.name))
+                count += 1
+            except FileNotFoundError:
+                continue  # <--- recovered by another worker meanwhile
+
+        return count
+
+    def __release(self, directory: Path, lock: IO) -> int:
+        """Requeue the jobs of a locked running directory and remove it, return the number of jobs"""
+        count = self.__requeue_all(directory)
+
+        lock.close()  # <--- windows can not remove an open file
+        try:
+            directory.joinpath('.lock').unlink(missing_ok=True)
+            directory.rmdir()
+        except OSError:
+            pass  # <--- removed by another worker, or locked again before we could remove it
+
+        return count
+
+    @staticmethod
+    def __try_lock(lock: IO) -> bool:
+        """Take an exclusive lock on an open file without waiting, return False if it is held elsewhere"""
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+
+        return True
+
+    def __reject(self, path: Path, error: str) -> None:
+        """Move a job file to failed/ with the error"""
+        try:
+            data = json.loads(path.read_text())
+            if not isinstance(data, dict):
+                raise ValueError
+        except ValueError:
+            data = {'job': path.read_text(errors='replace')}
+
+        data['error'] = error
+        data['failed_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        target = self.failed.joinpath(path.name)
+        temp = target.with_suffix('.tmp')
+        temp.write_text(json.dumps(data, indent=2))
+        temp.replace(target)
+        path.unlink(missing_ok=True)
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')
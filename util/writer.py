@@ -0,0 +1,102 @@
+import asyncio
+import threading
+from typing import BinaryIO, Callable, Optional
+
+
+class OrderedWriter(object):
+    """
+    Write segments to one file in playlist order
+
+    Segments finishing out of order are held in a bounded reorder buffer until every segment before them
+    has been written. Workers reserve a slot before downloading, so at most `window` segments past the
+    next one to be written can be in flight or buffered at the same time. Threads wait on a condition,
+    coroutines on a future woken when the next segment is written.
+
+    Args:
+        file (BinaryIO): output file, positioned where the next segment should be written
+        start (int): index of the next segment to write
+        window (int): max number of segments ahead of the next one to write
+        on_written (Callable[[int, int], None], optional): called with index and size after a segment is written.
+            Defaults to None.
+    """
+    def __init__(self, file: BinaryIO, start: int, window: int,
+                 on_written: Optional[Callable[[int, int], None]] = None) -> None:
+        self.file = file
+        self.next = start
+        self.window = window
+        self.on_written = on_written
+
+        self.buffer = {}
+        self.aborted = False
+        self.condition = threading.Condition()
+        self.waiters = []  # (loop, future) of coroutines waiting for the window to move
+
+    def ready(self, index: int) -> bool:
+        """Check if the segment fits in the reorder window (never blocks)"""
+        return self.aborted or index < self.next + self.window
+
+    def reserve(self, index: int) -> bool:
+        """Wait until the segment fits in the reorder window, return False if the writer is aborted"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.ready(index))
+            return not self.aborted
+
+    async def reserve_async(self, index: int) -> bool:
+        """Wait until the segment fits in the reorder window without blocking the loop, like reserve"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.ready(index):
+                    return not self.aborted
+
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+
+            await future
+
+    def write(self, index: int, data: bytes) -> None:
+        """Write the segment, or keep it until the segments before it are written"""
+        with self.condition:
+            if self.aborted:
+                return
+
+            self.buffer[index] = data
+            start = self.next
+            while self.next in self.buffer:
+                data = self.buffer.pop(self.next)
+                self.file.write(data)
+
+                if self.on_written is not None:
+                    self.on_written(self.next, len(data))
+
+                self.next += 1
+
+            self.condition.notify_all()
+            if self.next != start:
+                self.__wake()
+
+    def abort(self) -> None:
+        """Drop buffered segments and release every waiting worker"""
+        with self.condition:
+            self.aborted = True
+            self.buffer.clear()
+            self.condition.notify_all()
+            self.__wake()
+
+    def __wake(self) -> None:
+        """Wake every waiting coroutine in its own loop, called with the condition held"""
+        for loop, future in self.waiters:
+            try:
+                loop.call_soon_threadsafe(self.__resolve, future)
+            except RuntimeError:
+                continue  # <--- the loop is closed, nobody is waiting there anymore
+        self.waiters.clear()
+
+    @staticmethod
+    def __resolve(future: asyncio.Future) -> None:
+        if not future.done():
+            future.set_result(None)
+
+
+if __name__ == '__main__':
+    raise RuntimeError('This file is not intended to be run as a standalone script.')